@@ -0,0 +1,115 @@
+"""
+写入路径微基准：从本地模拟 CDN 下载一个大文件，对比旧的 iter_content + f.write 循环
+与 download_file 的 readinto 复用缓冲路径（不同缓冲大小、是否预分配）。
+
+模拟 CDN 在子进程中运行，os.times 只统计下载端的用户态/内核态 CPU；
+报告墙钟吞吐（MB/s）与每核吞吐（字节数 / 下载端 CPU 秒），每种写法取 CPU 最少的一次。
+
+运行：python bench/bench_copy.py --size 512 --repeat 3
+"""
+
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import local_downloader  # noqa: E402
+
+
+def legacy_download(url: str, path: str, session: requests.Session):
+    """改动前 download_file 的核心循环：每块新建一个 bytes 对象。"""
+    with session.get(url, stream=True, timeout=30) as r:
+        r.raise_for_status()
+        with open(path, "wb") as f:
+            for chunk in r.iter_content(chunk_size=1024 * 512):
+                if chunk:
+                    f.write(chunk)
+
+
+def start_cdn() -> tuple:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    proc = subprocess.Popen([sys.executable, os.path.join(HERE, "mock_cdn.py"), "--port", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return proc, base
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("模拟 CDN 未能启动")
+
+
+def measure(fn, path: str, size: int, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        # 删除旧文件不计入耗时，避免把回收页缓存的开销算到某一种写法上
+        if os.path.exists(path):
+            os.remove(path)
+        wall0, t0 = time.perf_counter(), os.times()
+        fn()
+        wall, t1 = time.perf_counter() - wall0, os.times()
+        user, system = t1.user - t0.user, t1.system - t0.system
+        if best is None or user + system < best[1] + best[2]:
+            best = (wall, user, system)
+    wall, user, system = best
+    mb = size / 1024 / 1024
+    cpu = user + system
+    return {"wall_s": round(wall, 3), "user_s": round(user, 3), "sys_s": round(system, 3),
+            "mb_per_s": round(mb / wall, 1), "mb_per_cpu_s": round(mb / cpu, 1) if cpu > 0 else None}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=512, help="文件大小（MB）")
+    parser.add_argument("--repeat", type=int, default=3, help="每种写法重复次数，取 CPU 最少的一次")
+    parser.add_argument("--dir", help="写入目录（默认临时目录；可指向真实磁盘对比预分配）")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    proc, base = start_cdn()
+    root = tempfile.mkdtemp(prefix="jdvideo-copy-", dir=args.dir)
+    session = requests.Session()
+    url = f"{base}/v/copy.mp4?size={size}"
+    path = os.path.join(root, "copy.mp4")
+
+    def optimized(buffer_size: int, preallocate: bool = False):
+        def run():
+            ok, err = local_downloader.download_file(url, path, 0, session=session, buffer_size=buffer_size,
+                                                     preallocate=preallocate)
+            if not ok:
+                raise RuntimeError(err)
+        return run
+
+    cases = [
+        ("iter_content 512KB", lambda: legacy_download(url, path, session)),
+        ("readinto 256KB", optimized(256 * 1024)),
+        ("readinto 1MB", optimized(1024 * 1024)),
+        ("readinto 4MB", optimized(4 * 1024 * 1024)),
+        ("readinto 1MB + fallocate", optimized(1024 * 1024, preallocate=True)),
+    ]
+    try:
+        for name, fn in cases:
+            result = measure(fn, path, size, args.repeat)
+            assert os.path.getsize(path) == size
+            print(json.dumps({"case": name, **result}, ensure_ascii=False), flush=True)
+    finally:
+        proc.kill()
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
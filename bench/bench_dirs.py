@@ -0,0 +1,132 @@
+"""
+目录创建开销基准：一个大批次（默认 2000 个短视频，分布在 20 个子目录）逐个 download_file，
+对比每次都 os.makedirs(exist_ok=True) 的旧 ensure_dir 与带已知目录缓存的 ensure_dir。
+
+有 strace 时以 `strace -f -c` 运行下载进程，报告 stat/mkdir 类系统调用次数与总系统调用数；
+没有 strace 时在进程内统计整个下载循环里 os.stat/os.mkdir 的调用次数
+（makedirs 只通过这两者访问文件系统；其余 stat 来自 .part 残片检查，两种写法相同）。
+模拟 CDN 在单独的子进程中运行，不计入统计。
+
+运行：python bench/bench_dirs.py --items 2000 --dirs 20
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import local_downloader  # noqa: E402
+from bench_copy import start_cdn  # noqa: E402
+
+# strace -c 中与目录检查/创建相关的系统调用
+DIR_SYSCALLS = ("stat", "lstat", "newfstatat", "fstatat64", "statx", "mkdir", "mkdirat")
+
+
+def legacy_ensure_dir(path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+
+def download_batch(base: str, root: str, mode: str, items: int, dirs: int) -> float:
+    """在当前进程中下载整批，返回耗时。"""
+    cached = local_downloader.ensure_dir
+    if mode == "legacy":
+        local_downloader.ensure_dir = legacy_ensure_dir
+    session = requests.Session()
+    try:
+        t0 = time.perf_counter()
+        for i in range(items):
+            path = local_downloader.build_path(root, f"sub{i % dirs}", str(i), "bench")
+            ok, err = local_downloader.download_file(f"{base}/v/{i}.mp4?size=4096", path, 0, session=session)
+            if not ok:
+                raise RuntimeError(err)
+        return time.perf_counter() - t0
+    finally:
+        local_downloader.ensure_dir = cached
+
+
+def count_in_process(base: str, root: str, mode: str, items: int, dirs: int) -> dict:
+    counts = {"stat": 0, "mkdir": 0}
+    real_stat, real_mkdir = os.stat, os.mkdir
+
+    def stat(*args, **kwargs):
+        counts["stat"] += 1
+        return real_stat(*args, **kwargs)
+
+    def mkdir(*args, **kwargs):
+        counts["mkdir"] += 1
+        return real_mkdir(*args, **kwargs)
+
+    os.stat, os.mkdir = stat, mkdir
+    try:
+        elapsed = download_batch(base, root, mode, items, dirs)
+    finally:
+        os.stat, os.mkdir = real_stat, real_mkdir
+    return {"elapsed_s": round(elapsed, 3), "counter": "in-process", **counts}
+
+
+def parse_strace(path: str) -> dict:
+    calls = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            # % time / seconds / usecs/call / calls / [errors] / syscall
+            if len(parts) >= 5 and parts[0][0].isdigit() and parts[3].isdigit() and parts[-1] != "total":
+                calls[parts[-1]] = int(parts[3])
+    return calls
+
+
+def count_with_strace(strace: str, base: str, root: str, mode: str, items: int, dirs: int) -> dict:
+    out = os.path.join(root, "strace.txt")
+    cmd = [strace, "-f", "-c", "-o", out, sys.executable, os.path.abspath(__file__), "--worker", mode,
+           "--base", base, "--root", root, "--items", str(items), "--dirs", str(dirs)]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    calls = parse_strace(out)
+    return {"elapsed_s": json.loads(result.stdout)["elapsed_s"], "counter": "strace",
+            "dir_syscalls": sum(calls.get(name, 0) for name in DIR_SYSCALLS),
+            "total_syscalls": sum(calls.values()),
+            **{name: calls[name] for name in DIR_SYSCALLS if calls.get(name)}}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=2000)
+    parser.add_argument("--dirs", type=int, default=20, help="条目分布的子目录数")
+    parser.add_argument("--worker", choices=("legacy", "cached"), help=argparse.SUPPRESS)
+    parser.add_argument("--base", help=argparse.SUPPRESS)
+    parser.add_argument("--root", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        elapsed = download_batch(args.base, args.root, args.worker, args.items, args.dirs)
+        print(json.dumps({"elapsed_s": round(elapsed, 3)}))
+        return
+
+    strace = shutil.which("strace")
+    proc, base = start_cdn()
+    try:
+        for mode in ("legacy", "cached"):
+            root = tempfile.mkdtemp(prefix="jdvideo-dirs-")
+            try:
+                if strace:
+                    result = count_with_strace(strace, base, root, mode, args.items, args.dirs)
+                else:
+                    result = count_in_process(base, root, mode, args.items, args.dirs)
+            finally:
+                shutil.rmtree(root, ignore_errors=True)
+            print(json.dumps({"ensure_dir": mode, "items": args.items, **result}, ensure_ascii=False), flush=True)
+    finally:
+        proc.kill()
+
+
+if __name__ == "__main__":
+    main()
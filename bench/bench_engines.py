@@ -0,0 +1,125 @@
+"""
+传输引擎对比：同一批大量短视频，分别用 --engine thread 与 --engine async 在相同并发上限下下载。
+
+模拟 CDN 带首字节延迟与每连接限速，使整批耗时取决于能同时挂起多少个传输。
+每种组合启动一个全新的 local_downloader.py 子进程，报告整批耗时、条目/秒、
+条目完成延迟 p50/p99、服务进程的 CPU 时间、峰值 RSS 与峰值线程数（读 /proc，仅 Linux）。
+
+运行：python bench/bench_engines.py --items 2000 --concurrency 50,500
+"""
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from bench_suite import free_port, percentile, scrape, stop_server, watch_events  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+
+def thread_count(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("Threads:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def start_server(root: str, engine: str, concurrency: int) -> tuple:
+    port = free_port()
+    cmd = [sys.executable, os.path.join(REPO, "local_downloader.py"), "--port", str(port), "--root", root,
+           "--engine", engine, "--concurrency", str(concurrency), "--retry", "0", "--no-dedupe", "--no-journal"]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            requests.get(base + "/", timeout=1)
+            return proc, base
+        except requests.ConnectionError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError("下载服务未能启动：" + " ".join(cmd))
+            time.sleep(0.05)
+
+
+def run_case(engine: str, concurrency: int, cdn: MockCDN, args, run_id: str) -> dict:
+    root = tempfile.mkdtemp(prefix="jdvideo-engine-")
+    proc, base = start_server(root, engine, concurrency)
+    try:
+        done_at, job_done, ready = {}, threading.Event(), threading.Event()
+        threading.Thread(target=watch_events, args=(base, done_at, job_done, ready), daemon=True).start()
+        ready.wait(5)
+        items = [
+            {"sku": str(i), "title": "bench",
+             "videoUrl": f"{cdn.base_url}/v/{run_id}-{engine}-{concurrency}-{i}.mp4?size={args.size}&bps={args.bps}&latency={args.latency}"}
+            for i in range(args.items)
+        ]
+        peak_threads = thread_count(proc.pid)
+        t0 = time.perf_counter()
+        requests.post(base + "/download", json={"items": items, "target_dir": root}, timeout=60)
+        while not job_done.wait(0.1):
+            peak_threads = max(peak_threads, thread_count(proc.pid))
+            if time.perf_counter() - t0 > args.timeout:
+                break
+        elapsed = time.perf_counter() - t0
+        metrics = scrape(base)
+        latencies = [(at - t0) * 1000 for at, _ in done_at.values()]
+        ok = sum(1 for _, state in done_at.values() if state == "ok")
+        result = {
+            "engine": engine,
+            "concurrency": concurrency,
+            "finished": job_done.is_set(),
+            "elapsed_s": round(elapsed, 3),
+            "ok": ok,
+            "fail": len(done_at) - ok,
+            "items_per_s": round(ok / elapsed, 1) if elapsed > 0 else 0.0,
+            "downloaded_mb": round(metrics.get("jdvideo_downloaded_bytes_total", 0.0) / 1024 / 1024, 2),
+            "item_p50_ms": round(percentile(latencies, 50), 1),
+            "item_p99_ms": round(percentile(latencies, 99), 1),
+            "peak_threads": peak_threads,
+        }
+    finally:
+        usage = stop_server(proc)
+        shutil.rmtree(root, ignore_errors=True)
+    result.update(usage)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=2000, help="批次条目数")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="每个视频字节数")
+    parser.add_argument("--bps", type=float, default=1024 * 1024, help="模拟 CDN 每连接带宽（字节/秒）")
+    parser.add_argument("--latency", type=float, default=0.2, help="模拟 CDN 首字节延迟（秒）")
+    parser.add_argument("--concurrency", default="50,500", help="逗号分隔的并发上限")
+    parser.add_argument("--engines", default="thread,async")
+    parser.add_argument("--timeout", type=float, default=600.0, help="单轮最长等待时间（秒）")
+    args = parser.parse_args()
+
+    cdn = MockCDN().start()
+    run_id = str(int(time.time()))
+    try:
+        for concurrency in [int(c) for c in args.concurrency.split(",") if c.strip()]:
+            for engine in [e.strip() for e in args.engines.split(",") if e.strip()]:
+                print(json.dumps(run_case(engine, concurrency, cdn, args, run_id), ensure_ascii=False), flush=True)
+    finally:
+        cdn.stop()
+
+
+if __name__ == "__main__":
+    main()
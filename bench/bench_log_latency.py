@@ -0,0 +1,104 @@
+"""
+/log 延迟基准：在一个大批次下载进行中，持续并发 POST /log，统计 p50/p99 延迟。
+
+同时对比单线程处理（backlog 同为 128）与默认的多线程服务。
+
+运行：python bench/bench_log_latency.py --items 50 --clients 8 --duration 5
+"""
+
+import argparse
+import json
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_downloader  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+class SingleThreadServer(local_downloader.DownloaderServer):
+    """同样的 backlog，但在主循环中串行处理请求。"""
+
+    def process_request(self, request, client_address):
+        socketserver.BaseServer.process_request(self, request, client_address)
+
+
+def run_case(threaded: bool, cdn: MockCDN, args) -> dict:
+    root = tempfile.mkdtemp(prefix="jdvideo-bench-")
+    server_cls = local_downloader.DownloaderServer if threaded else SingleThreadServer
+    server = local_downloader.create_server("127.0.0.1", 0, root, args.concurrency, 0, server_cls=server_cls)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    items = [
+        {"sku": str(i), "title": "bench", "videoUrl": f"{cdn.base_url}/v/{i}.mp4?size={args.size}&bps={args.bps}"}
+        for i in range(args.items)
+    ]
+    requests.post(base + "/download", json={"items": items, "target_dir": root}, timeout=60)
+
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def client(n: int):
+        seq = 0
+        while time.perf_counter() < deadline:
+            entry = {"ts": time.time(), "event": "bench:log", "data": {"client": n, "seq": seq}}
+            t0 = time.perf_counter()
+            requests.post(base + "/log", data=json.dumps(entry), headers={"Content-Type": "application/json"}, timeout=30)
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1000)
+            seq += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(args.clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    server.shutdown()
+    server.server_close()
+
+    return {
+        "server": "threaded" if threaded else "single",
+        "requests": len(latencies),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies) if latencies else 0.0, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=50, help="在途批次的条目数")
+    parser.add_argument("--size", type=int, default=8 * 1024 * 1024, help="每个视频字节数")
+    parser.add_argument("--bps", type=float, default=2 * 1024 * 1024, help="模拟 CDN 每连接带宽")
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--clients", type=int, default=8, help="并发 /log 客户端数")
+    parser.add_argument("--duration", type=float, default=5.0, help="每轮压测秒数")
+    args = parser.parse_args()
+
+    cdn = MockCDN().start()
+    try:
+        for threaded in (False, True):
+            print(json.dumps(run_case(threaded, cdn, args), ensure_ascii=False))
+    finally:
+        cdn.stop()
+
+
+if __name__ == "__main__":
+    main()
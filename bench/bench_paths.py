@@ -0,0 +1,112 @@
+"""
+路径解析微基准：一个 10k 条目的批次里每个条目的路径开销（normalize_root + build_path）。
+
+对比改动前的实现（每个条目都 os.path.join 三段路径、每次调用都重新扫描并向 stderr 打印的 normalize_root）
+与当前实现（批次目录与目标目录解析走 LRU 缓存，调试输出在日志级别之后）。两种场景：
+- batch：一次 /download 提交 N 个条目，目标目录解析一次，每个条目拼一次路径；
+- per-call：N 次 /download 各提交 1 个条目，每次都解析目标目录。
+旧实现的 stderr 输出重定向到 /dev/null，只计格式化与写入的开销，不含终端渲染。
+
+运行：python bench/bench_paths.py --items 10000
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_downloader  # noqa: E402
+
+
+def legacy_sanitize_part(text: str) -> str:
+    return (text or "unknown").replace("\\", "_").replace("/", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace('"', "_").replace("<", "_").replace(">", "_").replace("|", "_").strip()
+
+
+def legacy_build_path(root_dir: str, sub_dir: str, sku: str, title: str) -> str:
+    base = f"{legacy_sanitize_part(sku)}_{legacy_sanitize_part(title)}.mp4"
+    parts = [root_dir]
+    if sub_dir:
+        parts.append(sub_dir.strip("\\/"))
+    parts.append(base)
+    return os.path.join(*parts)
+
+
+def legacy_normalize_root(path: str, fallback_root: str) -> str:
+    """改动前的 normalize_root（Unix/WSL 分支），每次调用打印两行调试信息。"""
+    original_path = path
+    if not path:
+        return fallback_root
+    path = "".join(c for c in path if c.isprintable())
+    path = path.replace("：", ":").replace("　", " ").replace(" ", ":")
+    path = path.replace("\\", "/").strip().strip("/")
+    is_windows_path = False
+    drive_letter = None
+    if len(path) >= 2 and path[0].upper().isalpha() and path[1] == ":":
+        is_windows_path = True
+        drive_letter = path[0].upper()
+        path = "/" if len(path) == 2 else path[2:].lstrip("/")
+    print(f"[normalize] original='{original_path}' -> path='{path}' is_windows={is_windows_path} drive={drive_letter} os.name={os.name}", file=sys.stderr)
+    if is_windows_path:
+        final = os.path.abspath(f"/mnt/{drive_letter.lower()}/{path}")
+        print(f"[normalize] WSL conversion: -> {final}", file=sys.stderr)
+        return final
+    final = os.path.abspath(os.path.join(fallback_root, path))
+    print(f"[normalize] Unix relative: {path} -> {final}", file=sys.stderr)
+    return final
+
+
+def legacy_handler(target_dir: str, root: str) -> str:
+    print(f"[download] received target_dir raw: {repr(target_dir)}", file=sys.stderr)
+    target_dir = legacy_normalize_root(target_dir, root)
+    print(f"[download] normalized target_dir: {target_dir}", file=sys.stderr)
+    return target_dir
+
+
+def current_handler(target_dir: str, root: str) -> str:
+    logger = local_downloader.logger
+    logger.debug("[download] received target_dir raw: %r", target_dir)
+    target_dir = local_downloader.normalize_root(target_dir, root)
+    logger.debug("[download] normalized target_dir: %s", target_dir)
+    return target_dir
+
+
+def run(handler, build, items: list, target: str, root: str, per_call: bool) -> float:
+    t0 = time.perf_counter()
+    if per_call:
+        for sku, title in items:
+            build(handler(target, root), "讲解", sku, title)
+    else:
+        resolved = handler(target, root)
+        for sku, title in items:
+            build(resolved, "讲解", sku, title)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5, help="每种组合重复次数，取最快的一次")
+    parser.add_argument("--target", default="D：\\JDDownloads\\讲解视频", help="扩展传来的 target_dir 原始值")
+    args = parser.parse_args()
+
+    items = [(f"10000{i}", f"【直播讲解】第{i}款 防晒霜 50ml*2/套 \"限时\" <新品>?") for i in range(args.items)]
+    root = "/srv/jdvideo"
+    cases = [("legacy", legacy_handler, legacy_build_path), ("current", current_handler, local_downloader.build_path)]
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+        assert legacy_build_path(legacy_handler(args.target, root), "讲解", *items[1]) == \
+            local_downloader.build_path(current_handler(args.target, root), "讲解", *items[1])
+        for per_call in (False, True):
+            for name, handler, build in cases:
+                best = min(run(handler, build, items, args.target, root, per_call) for _ in range(args.repeat))
+                print(json.dumps({"scenario": "per-call" if per_call else "batch", "impl": name, "items": args.items,
+                                  "total_ms": round(best * 1000, 2),
+                                  "us_per_item": round(best / args.items * 1e6, 3)}, ensure_ascii=False),
+                      file=sys.__stdout__, flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+连接复用基准：同一 CDN 主机上的大量短视频，对比每次新建连接与 SessionPool 复用连接。
+
+统计模拟 CDN 收到的新建 TCP 连接数（即握手次数）与整批耗时；
+--connect-latency 模拟每次 TCP+TLS 握手的往返开销。
+
+运行：python bench/bench_sessions.py --items 200 --size 262144 --connect-latency 0.03
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_downloader  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+
+def run_case(pool_size: int, cdn: MockCDN, args) -> dict:
+    root = tempfile.mkdtemp(prefix="jdvideo-bench-")
+    server = local_downloader.create_server("127.0.0.1", 0, root, args.concurrency, 0, pool_size=pool_size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    items = [
+        {"sku": str(i), "title": "bench", "videoUrl": f"{cdn.base_url}/v/{i}.mp4?size={args.size}"}
+        for i in range(args.items)
+    ]
+    cdn.reset_stats()
+    started = time.perf_counter()
+    job_id = requests.post(base + "/download", json={"items": items, "target_dir": root}, timeout=60).json()["job_id"]
+    while True:
+        job = requests.get(f"{base}/jobs/{job_id}", timeout=30).json()["job"]
+        if job["state"] == "done":
+            break
+        time.sleep(0.02)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    server.server_close()
+
+    return {
+        "mode": f"pool_size={pool_size}" if pool_size else "no_pool",
+        "items": args.items,
+        "success": job["success"],
+        "handshakes": cdn.connections,
+        "requests": cdn.requests,
+        "batch_seconds": round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--size", type=int, default=256 * 1024, help="每个短视频字节数")
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--pool-size", type=int, default=10)
+    parser.add_argument("--connect-latency", type=float, default=0.03, help="模拟每次握手的耗时（秒）")
+    args = parser.parse_args()
+
+    cdn = MockCDN(connect_latency=args.connect_latency).start()
+    try:
+        for pool_size in (0, args.pool_size):
+            print(json.dumps(run_case(pool_size, cdn, args), ensure_ascii=False))
+    finally:
+        cdn.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+"""
+端到端基准套件：本地模拟 CDN + 真实的 local_downloader.py 子进程。
+
+对每个批次大小：启动一个全新的下载服务（独立目录、默认关闭去重），提交 POST /download，
+同时用若干客户端持续 POST /log；通过 GET /events 记录每个条目完成的时刻。报告：
+- 吞吐（MB/s）、整批耗时、成功/失败数与重试次数（取自 /metrics）
+- 单条目完成延迟与 /log 延迟的 p50/p99（毫秒）
+- 服务进程的 CPU 时间（用户态+内核态）与峰值 RSS（os.wait4 取该子进程自己的 rusage）
+
+--dedupe 改为测去重命中：服务开启去重，先把同一批 URL 下载到 warm/ 预热（不计入结果），
+再提交到 hit/ 计时；此时每个条目应只发一次条件 HEAD 再硬链接，报告中 cdn_requests（GET）
+应为 0、cdn_heads 等于批次大小，deduped 为命中去重的条目数。
+
+结果写成 JSON（--out），可用 --compare 与之前保存的结果逐项对比，便于跨版本发现退化。
+
+运行：python bench/bench_suite.py --batches 1,10,50 --out bench/results/baseline.json
+      python bench/bench_suite.py --fail 0.05 --stall 0.02 --html 0.01 --compare bench/results/baseline.json
+      python bench/bench_suite.py --dedupe --latency 0.05 --out bench/results/dedupe.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from mock_cdn import MockCDN  # noqa: E402
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scrape(base: str) -> dict:
+    """把 /metrics 文本解析为 {样本名（含标签）: 数值}。"""
+    values = {}
+    for line in requests.get(base + "/metrics", timeout=10).text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        name, _, value = line.rpartition(" ")
+        values[name] = float(value)
+    return values
+
+
+def start_server(root: str, args) -> tuple:
+    port = free_port()
+    cmd = [sys.executable, os.path.join(REPO, "local_downloader.py"), "--port", str(port), "--root", root,
+           "--concurrency", str(args.concurrency), "--retry", str(args.retry), "--retry-base", str(args.retry_base)]
+    cmd += ([] if args.dedupe else ["--no-dedupe"]) + args.server_args
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 10
+    while True:
+        try:
+            requests.get(base + "/", timeout=1)
+            return proc, base
+        except requests.ConnectionError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError("下载服务未能启动：" + " ".join(cmd))
+            time.sleep(0.05)
+
+
+def stop_server(proc) -> dict:
+    """SIGTERM 正常退出，并取回该子进程自己的 CPU 时间与峰值 RSS。"""
+    proc.terminate()
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+    except ChildProcessError:
+        return {}
+    # Linux 上 ru_maxrss 单位为 KB，macOS 为字节
+    rss_kb = usage.ru_maxrss / 1024 if sys.platform == "darwin" else usage.ru_maxrss
+    return {"cpu_user_s": round(usage.ru_utime, 3), "cpu_sys_s": round(usage.ru_stime, 3),
+            "max_rss_mb": round(rss_kb / 1024, 1)}
+
+
+def watch_events(base: str, done_at: dict, job_done: threading.Event, ready: threading.Event):
+    with requests.get(base + "/events", stream=True, timeout=(5, None)) as r:
+        ready.set()
+        # chunk_size=1：避免最后一个事件卡在读缓冲里
+        for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            event = json.loads(line[5:])
+            if event.get("type") == "state" and event.get("state") in ("ok", "fail"):
+                done_at[event["index"]] = (time.perf_counter(), event["state"], event.get("dedupe"))
+            elif event.get("type") == "job" and event.get("state") == "done":
+                job_done.set()
+                return
+
+
+def warm_up(base: str, items: list, root: str, timeout: float) -> dict:
+    """去重场景的预热：把同一批 URL 先下载到 warm/，等该批次结束，建立去重索引；返回此时的 /metrics。"""
+    done_at, job_done, ready = {}, threading.Event(), threading.Event()
+    watcher = threading.Thread(target=watch_events, args=(base, done_at, job_done, ready), daemon=True)
+    watcher.start()
+    ready.wait(5)
+    requests.post(base + "/download", json={"items": items, "target_dir": root, "sub_dir": "warm"}, timeout=60)
+    if not job_done.wait(timeout):
+        raise RuntimeError("去重预热批次未在超时内完成")
+    return scrape(base)
+
+
+def run_case(batch: int, cdn: MockCDN, args, run_id: str) -> dict:
+    root = tempfile.mkdtemp(prefix="jdvideo-suite-")
+    proc, base = start_server(root, args)
+    usage = {}
+    items = [
+        {"sku": str(i), "title": "bench",
+         "videoUrl": f"{cdn.base_url}/v/{run_id}-{batch}-{i}.mp4?size={args.size}&bps={args.bps}&latency={args.latency}&mp4={int(args.mp4)}"}
+        for i in range(batch)
+    ]
+    try:
+        # 计数器累计自进程启动，扣掉预热阶段的部分
+        baseline = warm_up(base, items, root, args.timeout) if args.dedupe else {}
+        done_at, job_done, ready = {}, threading.Event(), threading.Event()
+        watcher = threading.Thread(target=watch_events, args=(base, done_at, job_done, ready), daemon=True)
+        watcher.start()
+        ready.wait(5)
+
+        log_latencies = []
+        lock = threading.Lock()
+        stop = threading.Event()
+
+        def log_client(n: int):
+            http = requests.Session()
+            seq = 0
+            while not stop.is_set():
+                entry = {"ts": time.time(), "event": "bench:log", "sku": str(seq), "data": {"client": n, "seq": seq}}
+                t0 = time.perf_counter()
+                http.post(base + "/log", json=entry, timeout=30)
+                with lock:
+                    log_latencies.append((time.perf_counter() - t0) * 1000)
+                seq += 1
+                if args.log_interval > 0:
+                    time.sleep(args.log_interval)
+
+        clients = [threading.Thread(target=log_client, args=(n,), daemon=True) for n in range(args.log_clients)]
+        for t in clients:
+            t.start()
+
+        cdn.reset_stats()
+        job = {"items": items, "target_dir": root}
+        if args.dedupe:
+            job["sub_dir"] = "hit"
+        t0 = time.perf_counter()
+        requests.post(base + "/download", json=job, timeout=60)
+        finished = job_done.wait(args.timeout)
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        for t in clients:
+            t.join()
+
+        metrics = {k: v - baseline.get(k, 0.0) for k, v in scrape(base).items()}
+        item_latencies = [(at - t0) * 1000 for at, _, _ in done_at.values()]
+        ok = sum(1 for _, state, _ in done_at.values() if state == "ok")
+        downloaded = metrics.get("jdvideo_downloaded_bytes_total", 0.0)
+        result = {
+            "batch": batch,
+            "finished": finished,
+            "elapsed_s": round(elapsed, 3),
+            "ok": ok,
+            "fail": len(done_at) - ok,
+            "deduped": sum(1 for _, _, dedupe in done_at.values() if dedupe),
+            "retries": int(metrics.get("jdvideo_retries_total", 0)),
+            "downloaded_mb": round(downloaded / 1024 / 1024, 2),
+            "throughput_mbps": round(downloaded / 1024 / 1024 / elapsed, 2) if elapsed > 0 else 0.0,
+            "item_p50_ms": round(percentile(item_latencies, 50), 1),
+            "item_p99_ms": round(percentile(item_latencies, 99), 1),
+            "log_requests": len(log_latencies),
+            "log_p50_ms": round(percentile(log_latencies, 50), 2),
+            "log_p99_ms": round(percentile(log_latencies, 99), 2),
+            "cdn_requests": cdn.requests,
+            "cdn_heads": cdn.heads,
+            "cdn_faults": dict(cdn.faults),
+        }
+    finally:
+        usage = stop_server(proc)
+        shutil.rmtree(root, ignore_errors=True)
+    result.update(usage)
+    return result
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, capture_output=True, text=True, timeout=5)
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+# 越小越好的指标；其余数值指标越大越好
+LOWER_IS_BETTER = ("elapsed_s", "item_p50_ms", "item_p99_ms", "log_p50_ms", "log_p99_ms",
+                   "cpu_user_s", "cpu_sys_s", "max_rss_mb", "retries", "fail")
+COMPARED = ("throughput_mbps",) + LOWER_IS_BETTER
+
+
+def compare(old: dict, new: dict):
+    old_cases = {c["batch"]: c for c in old.get("cases", [])}
+    print(f"对比 {old.get('revision') or '?'} -> {new.get('revision') or '?'}")
+    for case in new["cases"]:
+        prev = old_cases.get(case["batch"])
+        if not prev:
+            continue
+        parts = []
+        for key in COMPARED:
+            a, b = prev.get(key), case.get(key)
+            if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+                continue
+            if not a:
+                parts.append(f"{key}={a}->{b}")
+                continue
+            change = (b - a) / a * 100
+            worse = change > 0 if key in LOWER_IS_BETTER else change < 0
+            # 变差超过 10% 的指标加 ! 标记
+            mark = "!" if worse and abs(change) >= 10 else ""
+            parts.append(f"{key}={a}->{b} ({change:+.0f}%){mark}")
+        print(f"  batch={case['batch']}: " + ", ".join(parts))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batches", default="1,10,50", help="逗号分隔的批次大小")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="每个视频字节数")
+    parser.add_argument("--bps", type=float, default=0.0, help="模拟 CDN 每连接带宽（字节/秒），0 表示不限")
+    parser.add_argument("--latency", type=float, default=0.0, help="模拟 CDN 首字节延迟（秒）")
+    parser.add_argument("--mp4", action="store_true", help="模拟 CDN 返回带 moov 的 MP4 结构（配合 -- --verify mp4）")
+    parser.add_argument("--fail", type=float, default=0.0, help="注入 503 的概率")
+    parser.add_argument("--html", type=float, default=0.0, help="注入 html 错误页的概率")
+    parser.add_argument("--stall", type=float, default=0.0, help="注入半途停顿断开的概率")
+    parser.add_argument("--stall-seconds", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0, help="故障注入的随机种子")
+    parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--retry", type=int, default=2)
+    parser.add_argument("--retry-base", type=float, default=0.1, help="传给服务端的重试退避基数（秒）")
+    parser.add_argument("--log-clients", type=int, default=2, help="并发 /log 客户端数")
+    parser.add_argument("--log-interval", type=float, default=0.01, help="每个 /log 客户端两次请求的间隔（秒）")
+    parser.add_argument("--dedupe", action="store_true", help="测去重命中：开启去重，预热一遍后再计时同一批 URL")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个批次的最长等待时间（秒）")
+    parser.add_argument("--out", help="结果 JSON 保存路径")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 对比")
+    parser.add_argument("server_args", nargs="*", help="追加给 local_downloader.py 的参数（写在 -- 之后）")
+    args = parser.parse_args()
+
+    cdn = MockCDN(fail=args.fail, html=args.html, stall=args.stall, stall_seconds=args.stall_seconds,
+                  seed=args.seed).start()
+    run_id = str(int(time.time()))
+    cases = []
+    try:
+        for batch in [int(b) for b in args.batches.split(",") if b.strip()]:
+            case = run_case(batch, cdn, args, run_id)
+            print(json.dumps(case, ensure_ascii=False), flush=True)
+            cases.append(case)
+    finally:
+        cdn.stop()
+
+    params = {k: v for k, v in vars(args).items() if k not in ("out", "compare")}
+    result = {"revision": git_revision(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "params": params, "cases": cases}
+    if args.out:
+        os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+
+if __name__ == "__main__":
+    main()
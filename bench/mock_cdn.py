@@ -0,0 +1,247 @@
+"""
+本地模拟视频 CDN（仅用于基准测试）
+
+URL 形如 /v/<name>.mp4?size=<字节数>&bps=<每连接限速>&latency=<首字节延迟秒>，
+返回确定性的伪随机内容，Content-Type 为 video/mp4；加 mp4=1 时内容带最小的
+ftyp/mdat/moov 顶层结构，可通过 --verify mp4 校验。
+支持 keep-alive；connections 统计新建 TCP 连接数，connect_latency 模拟 TLS 握手耗时。
+支持 Range / If-Range（ETag 由 size 决定），可用于续传与分段下载。
+HEAD 返回与 GET 相同的响应头（If-None-Match 命中时 304），供去重的条件 HEAD 使用；
+requests 只统计 GET，HEAD 单独计入 heads，且不参与故障注入。
+
+故障注入（概率 0~1，URL 参数优先于服务端默认值）：
+- fail：返回 503（带 Retry-After: 0）
+- html：返回 200 + text/html 错误页
+- stall：发出一半正文后停顿 stall_s 秒再断开连接
+是否注入由 (seed, 路径, 该路径第几次请求) 决定，与线程调度无关，结果可复现。
+
+单独启动：python bench/mock_cdn.py --port 8800
+"""
+
+import argparse
+import random
+import re
+import struct
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BLOCK = bytes(range(256)) * 256  # 64KB 重复块，避免为大文件占用内存
+FAULTS = ("fail", "html", "stall")
+MP4_HEAD = struct.pack(">I4s4sI4s4s", 24, b"ftyp", b"isom", 512, b"isom", b"mp41")
+MP4_TAIL = struct.pack(">I4s8s", 16, b"moov", b"\0" * 8)
+
+
+def mp4_frame(size: int) -> tuple:
+    """返回 size 字节 MP4 的 (开头, 结尾)：ftyp + mdat 头在前，moov 在后，中间为 mdat 正文。"""
+    mdat = size - len(MP4_HEAD) - len(MP4_TAIL)
+    return MP4_HEAD + struct.pack(">I4s", mdat, b"mdat"), MP4_TAIL
+
+
+class MockCDNHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头与响应体分两次写出；不关 Nagle 时 keep-alive 上的小文件每个都要等约 40ms 的延迟 ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        return
+
+    def setup(self):
+        super().setup()
+        with self.server.stats_lock:
+            self.server.connections += 1
+        if self.server.connect_latency > 0:
+            time.sleep(self.server.connect_latency)
+
+    def _params(self):
+        q = parse_qs(urlparse(self.path).query)
+
+        def get(name, default):
+            return float(q.get(name, [str(default)])[0])
+
+        size = int(get("size", self.server.default_size))
+        bps = get("bps", self.server.default_bps)
+        latency = get("latency", self.server.default_latency)
+        faults = {name: get(name, self.server.fault_rates.get(name, 0.0)) for name in FAULTS}
+        mp4 = q.get("mp4", ["0"])[0] == "1" and size >= 64
+        return size, bps, latency, faults, mp4
+
+    def do_GET(self):
+        size, bps, latency, faults, mp4 = self._params()
+        fault = self.server.pick_fault(urlparse(self.path).path, faults)
+        if latency > 0:
+            time.sleep(latency)
+        if fault == "fail":
+            body = b"service unavailable"
+            self.send_response(503)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if fault == "html":
+            body = b"<html><body>error</body></html>"
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        etag = f'"mock-{size}"'
+        start, end = 0, size - 1
+        m = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if m and size > 0 and (not if_range or if_range == etag) and int(m.group(1)) < size:
+            start = int(m.group(1))
+            end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+        length = end - start + 1
+        frame = mp4_frame(size) if mp4 else (b"", b"")
+        if fault == "stall":
+            self._write_body(start, length // 2, bps, size, frame)
+            time.sleep(self.server.stall_seconds)
+            self.close_connection = True
+            return
+        self._write_body(start, length, bps, size, frame)
+
+    def do_HEAD(self):
+        size, _, latency, _, _ = self._params()
+        with self.server.stats_lock:
+            self.server.heads += 1
+        if latency > 0:
+            time.sleep(latency)
+        etag = f'"mock-{size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(size))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", etag)
+        self.end_headers()
+
+    def _write_body(self, offset: int, length: int, bps: float, size: int, frame: tuple):
+        head, tail = frame
+        body_end = size - len(tail)
+        sent = 0
+        started = time.perf_counter()
+        while sent < length:
+            pos = offset + sent
+            if pos < len(head):
+                data = head[pos:]
+            elif pos >= body_end:
+                data = tail[pos - body_end:]
+            else:
+                # BLOCK 以 64KB 为周期，任意偏移处的内容都一致，Range 结果可拼接
+                data = BLOCK[pos % len(BLOCK):][: body_end - pos]
+            data = data[: length - sent]
+            self.wfile.write(data)
+            sent += len(data)
+            if bps > 0:
+                # 按每连接带宽上限节流
+                ahead = sent / bps - (time.perf_counter() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+class MockCDN(ThreadingHTTPServer):
+    daemon_threads = True
+    # 引擎对比会同时发起上千个连接，默认 backlog=5 会引入 SYN 重传延迟
+    request_queue_size = 1024
+
+    def __init__(self, host="127.0.0.1", port=0, size=1024 * 1024, bps=0.0, latency=0.0, connect_latency=0.0,
+                 fail=0.0, html=0.0, stall=0.0, stall_seconds=0.5, seed=0):
+        super().__init__((host, port), MockCDNHandler)
+        self.default_size = size
+        self.default_bps = bps
+        self.default_latency = latency
+        self.connect_latency = connect_latency
+        self.fault_rates = {"fail": fail, "html": html, "stall": stall}
+        self.stall_seconds = stall_seconds
+        self.seed = seed
+        self.stats_lock = threading.Lock()
+        self.requests = 0
+        self.heads = 0
+        self.connections = 0
+        self.faults = {name: 0 for name in FAULTS}
+        self._hits = {}
+
+    def pick_fault(self, path: str, rates: dict):
+        """统计请求数，并按概率决定本次请求注入哪种故障（None 表示正常响应）。"""
+        with self.stats_lock:
+            self.requests += 1
+            n = self._hits.get(path, 0)
+            self._hits[path] = n + 1
+        roll = random.Random(f"{self.seed}:{path}:{n}").random()
+        for name in FAULTS:
+            rate = rates.get(name, 0.0)
+            if roll < rate:
+                with self.stats_lock:
+                    self.faults[name] += 1
+                return name
+            roll -= rate
+        return None
+
+    def handle_error(self, request, client_address):
+        # 客户端中途断开（下载端被杀、分段提前结束）属正常情况，不打印堆栈
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.requests = 0
+            self.heads = 0
+            self.connections = 0
+            self.faults = {name: 0 for name in FAULTS}
+            self._hits.clear()
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockCDN":
+        threading.Thread(target=self.serve_forever, name="mock-cdn", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--size", type=int, default=1024 * 1024)
+    parser.add_argument("--bps", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--connect-latency", type=float, default=0.0)
+    parser.add_argument("--fail", type=float, default=0.0, help="返回 503 的概率")
+    parser.add_argument("--html", type=float, default=0.0, help="返回 html 错误页的概率")
+    parser.add_argument("--stall", type=float, default=0.0, help="发出一半正文后停顿并断开的概率")
+    parser.add_argument("--stall-seconds", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    cdn = MockCDN(args.host, args.port, args.size, args.bps, args.latency, args.connect_latency,
+                  args.fail, args.html, args.stall, args.stall_seconds, args.seed)
+    print(f"[mock-cdn] listening on {cdn.base_url}", flush=True)
+    try:
+        cdn.serve_forever()
+    except KeyboardInterrupt:
+        print("bye")
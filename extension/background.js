@@ -113,6 +113,7 @@ chrome.runtime.onMessage.addListener((message, sender, sendResponse) => {
   }
   if (message?.type === "SET_LOG_ENDPOINT") {
     logEndpoint = message.url || DEFAULT_LOG_ENDPOINT;
+    logBatchUnsupported = false;
     sendResponse({ ok: true, logEndpoint });
     return true;
   }
@@ -589,7 +590,54 @@ function log(event, data) {
   postLog(entry);
 }
 
+// 日志上报合并：攒一批后以 NDJSON 一次 POST 到 <logEndpoint>/batch，减少捕获期间的小请求
+const LOG_BATCH_SIZE = 50;
+const LOG_FLUSH_INTERVAL_MS = 1000;
+const pendingLogLines = [];
+let logFlushTimer = null;
+// 旧版本地服务没有 /log/batch：收到 404 后回退为逐条上报
+let logBatchUnsupported = false;
+
 function postLog(entry) {
+  try {
+    if (logBatchUnsupported) {
+      postLogSingle(entry);
+      return;
+    }
+    pendingLogLines.push(JSON.stringify(entry));
+    if (pendingLogLines.length >= LOG_BATCH_SIZE) {
+      flushLogs();
+    } else if (!logFlushTimer) {
+      logFlushTimer = setTimeout(flushLogs, LOG_FLUSH_INTERVAL_MS);
+    }
+  } catch (e) {
+    // ignore
+  }
+}
+
+function flushLogs() {
+  if (logFlushTimer) {
+    clearTimeout(logFlushTimer);
+    logFlushTimer = null;
+  }
+  if (!pendingLogLines.length) return;
+  const lines = pendingLogLines.splice(0, pendingLogLines.length);
+  const url = (logEndpoint || DEFAULT_LOG_ENDPOINT).replace(/\/+$/, "") + "/batch";
+  fetch(url, {
+    method: "POST",
+    headers: { "Content-Type": "application/x-ndjson" },
+    body: lines.join("\n") + "\n"
+  })
+    .then((res) => {
+      if (res.status === 404) {
+        logBatchUnsupported = true;
+        lines.forEach((line) => postLogSingle(JSON.parse(line)));
+      }
+    })
+    .catch(() => {});
+}
+
+function postLogSingle(entry) {
   try {
     const url = logEndpoint || DEFAULT_LOG_ENDPOINT;
     fetch(url, {
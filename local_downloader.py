@@ -4,48 +4,116 @@
 功能：
 - 接收扩展发送的 SKU/标题/视频 URL 列表，保存到指定目录。
 - 支持子目录（扩展传 sub_dir）和目标根目录（target_dir，绝对路径）。
-- 简单并发与重试，日志输出到控制台。
+- 全局并发上限（可选单主机上限）与重试，批次间轮询调度，日志输出到控制台。
+- /download 入队后立即返回 job_id，通过 GET /jobs、GET /jobs/<id> 查询进度。
 
-依赖：requests
+依赖：requests（--engine async 另需 aiohttp）
 安装：pip install requests
 
 启动：python local_downloader.py --host 127.0.0.1 --port 3030 --root ./downloads --concurrency 3
 """
 
 import argparse
+import asyncio
+import gzip
+import hashlib
+import io
 import json
+import logging
 import os
+import queue
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import sys
 import threading
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import Optional
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from urllib.parse import urlparse
+import time
+import uuid
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from http.client import HTTPException, HTTPResponse
+from http.cookiejar import DefaultCookiePolicy
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:  # 只有 --engine async 需要
+    aiohttp = None
+
+try:
+    import fcntl
+except ImportError:  # Windows：没有 reflink
+    fcntl = None
+
+logger = logging.getLogger("jdvideo")
 
 
 def sanitize_part(text: str) -> str:
+    # 逐个 str.replace：没有命中时不分配新字符串；含中文的标题上比 str.translate 快数倍
     return (text or "unknown").replace("\\", "_").replace("/", "_").replace(":", "_").replace("*", "_").replace("?", "_").replace('"', "_").replace("<", "_").replace(">", "_").replace("|", "_").strip()
 
 
-def build_path(root_dir: str, sub_dir: str, sku: str, title: str) -> str:
-    base = f"{sanitize_part(sku)}_{sanitize_part(title)}.mp4"
-    parts = [root_dir]
+@lru_cache(maxsize=1024)
+def _item_dir(root_dir: str, sub_dir: str) -> str:
+    """批次的保存目录，末尾带分隔符；同一批次的所有条目只拼接一次。"""
     if sub_dir:
-        parts.append(sub_dir.strip("\\/"))
-    parts.append(base)
-    return os.path.join(*parts)
+        return os.path.join(root_dir, sub_dir.strip("\\/"), "")
+    return os.path.join(root_dir, "")
+
+
+def build_path(root_dir: str, sub_dir: str, sku: str, title: str) -> str:
+    # 文件名已去掉分隔符，直接拼在缓存的目录后面，结果与 os.path.join 相同
+    return f"{_item_dir(root_dir, sub_dir)}{sanitize_part(sku)}_{sanitize_part(title)}.mp4"
+
+
+# 已确认存在的目录；命中时 ensure_dir 不做任何系统调用。set 的查询与添加在 GIL 下是原子的
+_known_dirs = set()
+_KNOWN_DIRS_MAX = 4096
 
 
 def ensure_dir(path: str):
-    os.makedirs(os.path.dirname(path), exist_ok=True)
+    """确保 path 所在目录存在。多个线程同时创建同一目录时由 makedirs(exist_ok=True) 兜底；
+    目录在运行中被外部删除时，调用方遇到 FileNotFoundError 后用 forget_dir 让下次重新创建。"""
+    directory = os.path.dirname(path)
+    if directory in _known_dirs:
+        return
+    os.makedirs(directory, exist_ok=True)
+    if len(_known_dirs) >= _KNOWN_DIRS_MAX:
+        _known_dirs.clear()
+    _known_dirs.add(directory)
+
+
+def forget_dir(path: str):
+    _known_dirs.discard(os.path.dirname(path))
 
 
 def normalize_root(path: str, fallback_root: str) -> str:
-    """规范化根目录，修正全角冒号/意外相对路径，确保为绝对路径。"""
-    original_path = path
+    """规范化根目录，修正全角冒号/意外相对路径，确保为绝对路径。
+
+    结果按 (原始路径, fallback_root, os.name) 缓存在有界 LRU 中，同一目标目录只解析一次。
+    """
     if not path:
         return fallback_root
+    return _normalize_root(path, fallback_root, os.name)
+
+
+@lru_cache(maxsize=256)
+def _normalize_root(path: str, fallback_root: str, os_name: str) -> str:
+    original_path = path
     
     # 去除所有不可见字符和特殊空白字符
     path = "".join(c for c in path if c.isprintable())
@@ -57,8 +125,10 @@ def normalize_root(path: str, fallback_root: str) -> str:
     
     # 统一路径分隔符
     path = path.replace("\\", "/")
-    # 去除首尾空格和斜杠
-    path = path.strip().strip("/")
+    # 去除首尾空格和斜杠（Unix 绝对路径开头的 / 记下来，下面还原）
+    path = path.strip()
+    rooted = path.startswith("/")
+    path = path.strip("/")
     
     # 检测Windows驱动器路径（如 D:/xxx、D:\xxx、D:xxx）
     is_windows_path = False
@@ -76,87 +146,2750 @@ def normalize_root(path: str, fallback_root: str) -> str:
             else:
                 path = path[2:].lstrip("/")
     
-    # 日志记录（用于调试）
-    import sys
-    print(f"[normalize] original='{original_path}' -> path='{path}' is_windows={is_windows_path} drive={drive_letter} os.name={os.name}", file=sys.stderr)
+    logger.debug("[normalize] original=%r -> path=%r is_windows=%s drive=%s os.name=%s",
+                 original_path, path, is_windows_path, drive_letter, os_name)
     
     # 如果在WSL/Unix环境下检测到Windows路径，转换为/mnt/drive格式
-    if is_windows_path and os.name != "nt":
+    if is_windows_path and os_name != "nt":
         # WSL环境下：D:/JDDownloads -> /mnt/d/JDDownloads
         result = f"/mnt/{drive_letter.lower()}/{path}"
         final = os.path.abspath(result)
-        print(f"[normalize] WSL conversion: {result} -> {final}", file=sys.stderr)
+        logger.debug("[normalize] WSL conversion: %s -> %s", result, final)
         return final
     
     # Windows环境下
-    if os.name == "nt":
+    if os_name == "nt":
         if is_windows_path:
             # 还原完整Windows路径
             result = f"{drive_letter}:\\{path.replace('/', os.sep)}"
             final = os.path.abspath(result)
-            print(f"[normalize] Windows path: {result} -> {final}", file=sys.stderr)
+            logger.debug("[normalize] Windows path: %s -> %s", result, final)
             return final
         elif not os.path.isabs(path):
             # 相对路径映射到fallback_root（这是问题所在！）
             result = os.path.join(fallback_root, path)
             final = os.path.abspath(result)
-            print(f"[normalize] WARNING: Relative path detected! '{path}' -> '{result}' -> '{final}'", file=sys.stderr)
-            print(f"[normalize] fallback_root='{fallback_root}'", file=sys.stderr)
+            logger.warning("[normalize] relative path %r -> %r (fallback_root=%r)", path, final, fallback_root)
             return final
         else:
             final = os.path.abspath(path)
-            print(f"[normalize] Already absolute: {path} -> {final}", file=sys.stderr)
+            logger.debug("[normalize] Already absolute: %s -> %s", path, final)
             return final
     
     # Unix环境下（非WSL，没有Windows驱动器）
+    if rooted:
+        path = "/" + path
     if not os.path.isabs(path):
         # 如果仍然不是绝对路径，使用fallback_root
         result = os.path.join(fallback_root, path)
         final = os.path.abspath(result)
-        print(f"[normalize] Unix relative: {path} -> {result} -> {final}", file=sys.stderr)
+        logger.debug("[normalize] Unix relative: %s -> %s -> %s", path, result, final)
         return final
     
     final = os.path.abspath(path)
-    print(f"[normalize] Final: {path} -> {final}", file=sys.stderr)
+    logger.debug("[normalize] Final: %s -> %s", path, final)
     return final
 
 
-def download_file(url: str, path: str, retry: int = 2, headers: Optional[dict] = None):
+class SessionPool:
+    """按主机复用 requests.Session（keep-alive 连接池），跨条目、重试与批次共享。
+
+    urllib3 连接池本身线程安全；会话不保存服务端下发的 Cookie，
+    每个条目的 Cookie 仍只来自扩展传入的 headers，避免批次之间串号。
+    """
+
+    def __init__(self, pool_size: int = 10):
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url: str) -> requests.Session:
+        host = urlparse(url).netloc
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._sessions[host] = self._new_session()
+        return session
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # pool_connections 覆盖 CDN 302 跳转到的其他主机，pool_maxsize 为单主机保持的连接数
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+def _request_headers(headers: Optional[dict]) -> dict:
+    req_headers = {}
+    if headers:
+        if headers.get("referer"):
+            req_headers["Referer"] = headers.get("referer")
+        if headers.get("cookie"):
+            req_headers["Cookie"] = headers.get("cookie")
+        if headers.get("ua"):
+            req_headers["User-Agent"] = headers.get("ua")
+    return req_headers
+
+
+def _parse_content_range(value: str):
+    """解析 'bytes start-end/total'，返回 (start, total)；total 未知时为 None。"""
+    try:
+        unit, spec = value.split(" ", 1)
+        span, total = spec.split("/", 1)
+        if unit.strip() != "bytes":
+            return None, None
+        return int(span.split("-", 1)[0]), (None if total.strip() == "*" else int(total))
+    except (AttributeError, ValueError):
+        return None, None
+
+
+def retry_after_seconds(exc: Exception) -> Optional[float]:
+    """从 HTTP 错误响应中读取 Retry-After（秒数或 HTTP 日期）。"""
+    response = getattr(exc, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: Optional[float] = None) -> float:
+    """第 attempt 次重试前的等待：指数退避 + 全抖动，服务端给了 Retry-After 时不早于它。"""
+    delay = random.uniform(0, min(cap, base * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap * 5))
+    return delay
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 burst 个。"""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def try_take(self, n: float = 1) -> float:
+        """令牌足够则取走并返回 0，否则不取，返回还需等待的秒数。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= n:
+                self.tokens -= n
+                return 0.0
+            return (n - self.tokens) / self.rate
+
+    def take(self, n: float) -> float:
+        """无条件取走 n 个令牌（允许欠账），返回调用方应等待的秒数。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= n
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class HostLimiter:
+    """按主机的请求速率（rps）与字节速率（bps）令牌桶，0 表示不限。"""
+
+    def __init__(self, rps: float = 0.0, bps: float = 0.0):
+        self.rps = rps
+        self.bps = bps
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, kind: str, host: str, rate: float, burst: float) -> TokenBucket:
+        key = (kind, host)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(key, TokenBucket(rate, burst))
+        return bucket
+
+    def request_wait(self, host: str) -> float:
+        """尝试为一次请求取令牌；返回 0 表示可以立即发起，否则为需要等待的秒数。"""
+        if not self.rps:
+            return 0.0
+        return self._bucket("rps", host, self.rps, max(1.0, self.rps)).try_take()
+
+    def bytes_wait(self, host: str, n: int) -> float:
+        """记入 n 个已写入字节，返回为不超出字节速率应等待的秒数。"""
+        if not self.bps:
+            return 0.0
+        return self._bucket("bps", host, self.bps, self.bps).take(n)
+
+
+# 磁盘空间准入拒绝时的错误信息前缀；文件比整个文件系统还大时用后者，等待也无济于事
+DISK_FULL = "insufficient disk space"
+DISK_TOO_SMALL = DISK_FULL + " (filesystem too small)"
+
+
+def classify_error(exc: Exception) -> str:
+    """把下载异常归类为 http_403/http_429/http_5xx/http_<code>/timeout/connection/html/incomplete/verify/cancelled/disk/other。"""
+    if isinstance(exc, requests.HTTPError) and exc.response is not None:
+        code = exc.response.status_code
+        return "http_5xx" if code >= 500 else f"http_{code}"
+    if isinstance(exc, requests.Timeout):
+        return "timeout"
+    if isinstance(exc, requests.ConnectionError):
+        return "connection"
+    message = str(exc)
+    if message.startswith("content-type is html"):
+        return "html"
+    if "incomplete" in message:
+        return "incomplete"
+    if message.startswith("verify failed"):
+        return "verify"
+    if message == "cancelled":
+        return "cancelled"
+    if message.startswith(DISK_FULL):
+        return "disk"
+    return "other"
+
+
+COPY_BUFFER = 1024 * 1024
+
+
+def _raw_body(r: requests.Response) -> Optional[HTTPResponse]:
+    """_copy_body 快速路径的前提检查：返回可以直接 readinto 的底层 http.client.HTTPResponse，否则返回 None。
+
+    快速路径绕过 urllib3 的 read()，依赖 requests/urllib3 的内部属性，只在以下条件全部成立时使用：
+    r.raw 是 urllib3 的 HTTPResponse；响应没有 Content-Encoding（无需解码）；urllib3 还没读过响应体
+    （_fp_bytes_read 为 0，没有内部缓冲）；_fp 是标准库的 http.client.HTTPResponse；
+    记账用的 length_remaining 与 requests 的 _content_consumed 都在。
+    任一条件不成立（包括上游升级后属性改名）时返回 None，调用方回退为 iter_content。
+    """
+    raw = r.raw
+    if not isinstance(raw, urllib3.response.HTTPResponse):
+        return None
+    if r.headers.get("Content-Encoding", "identity").lower() != "identity":
+        return None
+    if getattr(raw, "_fp_bytes_read", None) != 0 or not hasattr(raw, "length_remaining") \
+            or not hasattr(r, "_content_consumed"):
+        return None
+    fp = getattr(raw, "_fp", None)
+    return fp if isinstance(fp, HTTPResponse) else None
+
+
+def _finish_raw_body(r: requests.Response, fp: HTTPResponse, written: int):
+    """快速路径读完后补上 urllib3 的记账；响应体已读到结尾时告诉 requests
+    可以把连接放回连接池，而不是关闭。"""
+    raw = r.raw
+    raw._fp_bytes_read += written
+    if raw.length_remaining is not None:
+        raw.length_remaining = max(0, raw.length_remaining - written)
+    if fp.isclosed():
+        r._content_consumed = True
+
+
+def _copy_body(r: requests.Response, f, limit: Optional[int], buffer_size: int,
+               on_data: Optional[Callable[[memoryview], None]] = None) -> int:
+    """把响应体写入 f，最多 limit 字节（None 表示读到结束），返回写入的字节数；
+    on_data 在每块写入后以该块数据调用。
+
+    满足 _raw_body 前提的未压缩响应直接 readinto 到复用的缓冲区再写出，不为每块新建 bytes 对象；
+    其余响应（带 Content-Encoding 等）走 iter_content。
+    """
+    fp = _raw_body(r)
+    if fp is None:
+        written = 0
+        for chunk in r.iter_content(chunk_size=buffer_size):
+            if limit is not None:
+                chunk = chunk[: limit - written]
+            if not chunk:
+                continue
+            f.write(chunk)
+            written += len(chunk)
+            if on_data:
+                on_data(chunk)
+            if limit is not None and written >= limit:
+                break
+        return written
+    view = memoryview(bytearray(buffer_size))
+    written = 0
+    while limit is None or written < limit:
+        want = buffer_size if limit is None else min(buffer_size, limit - written)
+        try:
+            n = fp.readinto(view[:want])
+        except socket.timeout as e:
+            raise requests.exceptions.ReadTimeout(e) from e
+        except (OSError, HTTPException) as e:
+            # 与 iter_content 一致地归为连接错误，便于 classify_error 分类
+            raise requests.exceptions.ConnectionError(e) from e
+        if not n:
+            break
+        f.write(view[:n])
+        written += n
+        if on_data:
+            on_data(view[:n])
+    _finish_raw_body(r, fp, written)
+    return written
+
+
+def _abort_response(r: requests.Response):
+    """从其他线程中断一个正在读取的响应：关闭底层 socket 的读写，阻塞中的 recv 立即返回。
+    响应已读完、连接已放回连接池时不做任何事。"""
+    conn = getattr(r.raw, "connection", None)
+    sock = getattr(conn, "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def _read_part_meta(meta_path: str) -> dict:
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _drop_part(part_path: str, meta_path: str):
+    for p in (part_path, meta_path):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+
+def _resume_request(path: str, headers: Optional[dict]) -> tuple:
+    """准备一次下载请求：返回 (请求头, .part.json 元数据, 续传偏移)；可续传时带上 Range + If-Range。"""
+    ensure_dir(path)
+    part_path = path + ".part"
+    req_headers = _request_headers(headers)
+    meta = _read_part_meta(part_path + ".json")
+    offset = os.path.getsize(part_path) if meta and os.path.exists(part_path) else 0
+    validator = meta.get("etag") or meta.get("last_modified")
+    # 残片长度达到总大小说明是进程中断前预分配的文件，内容不可信，不续传
+    if offset and validator and offset < (meta.get("total") or 0):
+        req_headers["Range"] = f"bytes={offset}-"
+        req_headers["If-Range"] = validator
+    else:
+        offset = 0
+    return req_headers, meta, offset
+
+
+def _open_part(url: str, path: str, status: int, resp_headers, offset: int, meta: dict):
+    """按响应头决定续传还是重写 .part，返回 (写入模式, 偏移, 总大小)；续传校验失败时丢弃残片并返回 None。
+    resp_headers 为不区分大小写的响应头映射（requests 与 aiohttp 均可）。"""
+    part_path = path + ".part"
+    meta_path = part_path + ".json"
+    ctype = resp_headers.get("content-type", "")
+    if "text/html" in ctype:
+        raise Exception(f"content-type is html: {ctype}")
+    if offset and status == 206:
+        start, total = _parse_content_range(resp_headers.get("Content-Range"))
+        etag = resp_headers.get("ETag")
+        if start != offset or total != meta.get("total") or (etag and meta.get("etag") and etag != meta["etag"]):
+            _drop_part(part_path, meta_path)
+            return None
+        return "ab", offset, total
+    total = None
+    if resp_headers.get("Content-Length") and resp_headers.get("Content-Encoding", "identity") == "identity":
+        total = int(resp_headers["Content-Length"])
+    _drop_part(part_path, meta_path)
+    etag, last_modified = resp_headers.get("ETag"), resp_headers.get("Last-Modified")
+    if resp_headers.get("Accept-Ranges", "").lower() == "bytes" and total and (etag or last_modified):
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"url": url, "etag": etag, "last_modified": last_modified, "total": total}, f)
+    return "wb", 0, total
+
+
+def download_file(url: str, path: str, retry: int = 2, headers: Optional[dict] = None,
+                  progress: Optional[Callable[..., Optional[float]]] = None, session: Optional[requests.Session] = None,
+                  info: Optional[dict] = None, monitor: Optional[Callable[[str, dict], None]] = None,
+                  buffer_size: int = COPY_BUFFER, preallocate: bool = False):
+    """下载单个文件；progress 为可选回调，参数为本次写入的字节数（每次请求开始时以
+    progress(-1, total, done) 重置并告知总大小与续传前已有的字节数，未知时 total 为 None）；
+    返回正数时表示限速需要等待的秒数，由这里 sleep。
+    session 为空时每次请求新建连接。info 不为空时，成功后写入 size/total/etag/last_modified/sha256
+    （total 为响应声明的总大小，未知时为 None；SHA-256 在写入时流式计算，续传时先补算已有部分）。
+
+    数据先写入 <path>.part，完整后原子重命名为目标文件。服务端声明 Accept-Ranges 时，
+    <path>.part.json 记录 ETag/Last-Modified 与总大小，重试或之后重新提交同一文件时
+    用 Range + If-Range 续传；校验不一致则回退为完整下载。
+
+    monitor 为可选观测回调：每次请求收到响应头时 monitor("response", {"status", "ttfb", "abort"})，
+    其中 abort() 可从其他线程中断本次传输；每次尝试失败时 monitor("error", {"reason"})。
+
+    buffer_size 为复用的读缓冲与文件写缓冲大小；preallocate 为真且总大小已知时，
+    先用 posix_fallocate 预分配整个 .part 文件，失败或中断时截断回已写入的长度。
+    """
+    http = session or requests
+    part_path = path + ".part"
+    meta_path = part_path + ".json"
     attempt = 0
     while attempt <= retry:
         try:
-            ensure_dir(path)
-            req_headers = {}
-            if headers:
-                if headers.get("referer"):
-                    req_headers["Referer"] = headers.get("referer")
-                if headers.get("cookie"):
-                    req_headers["Cookie"] = headers.get("cookie")
-                if headers.get("ua"):
-                    req_headers["User-Agent"] = headers.get("ua")
-            with requests.get(url, stream=True, timeout=30, headers=req_headers) as r:
+            req_headers, meta, offset = _resume_request(path, headers)
+            sent = time.perf_counter()
+            with http.get(url, stream=True, timeout=30, headers=req_headers) as r:
+                if monitor:
+                    monitor("response", {"status": r.status_code, "ttfb": time.perf_counter() - sent,
+                                         "abort": lambda: _abort_response(r)})
                 r.raise_for_status()
-                ctype = r.headers.get("content-type", "")
-                if "text/html" in ctype:
-                    raise Exception(f"content-type is html: {ctype}")
-                with open(path, "wb") as f:
-                    for chunk in r.iter_content(chunk_size=1024 * 512):
-                        if chunk:
-                            f.write(chunk)
+                plan = _open_part(url, path, r.status_code, r.headers, offset, meta)
+                if plan is None:
+                    # 续传校验失败：残片已丢弃，下一轮完整下载（不计入重试次数）
+                    continue
+                mode, offset, total = plan
+                if progress:
+                    progress(-1, total, offset)
+                hasher = None
+                if info is not None:
+                    hasher = hashlib.sha256()
+                    if offset:
+                        _hash_file(part_path, hasher)
+                def on_data(data):
+                    if hasher:
+                        hasher.update(data)
+                    if progress:
+                        wait = progress(len(data))
+                        if wait:
+                            time.sleep(wait)
+
+                preallocated = preallocate and mode == "wb" and bool(total)
+                with open(part_path, mode, buffering=buffer_size) as f:
+                    if preallocated:
+                        _preallocate(f, total)
+                    try:
+                        _copy_body(r, f, None, buffer_size, on_data)
+                    finally:
+                        size = f.tell()
+                        if preallocated and size != total:
+                            f.truncate(size)
+                validators = {"etag": r.headers.get("ETag") or meta.get("etag"),
+                              "last_modified": r.headers.get("Last-Modified") or meta.get("last_modified")}
+            if total is not None and size != total:
+                raise Exception(f"incomplete download: {size}/{total} bytes")
+            _commit_part(path)
+            if info is not None:
+                info.update(validators, size=size, total=total, sha256=hasher.hexdigest())
             return True, None
         except Exception as e:
+            if isinstance(e, FileNotFoundError):
+                forget_dir(path)
+            retry_after = retry_after_seconds(e)
+            if monitor:
+                monitor("error", {"reason": classify_error(e), "retry_after": retry_after})
             attempt += 1
             if attempt > retry:
+                if not os.path.exists(meta_path):
+                    # 无法续传的残片没有保留价值
+                    _drop_part(part_path, meta_path)
                 return False, str(e)
+            time.sleep(backoff_delay(attempt - 1, retry_after=retry_after))
+
+
+def _hash_file(path: str, hasher=None):
+    hasher = hasher or hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher
+
+
+def probe_range(url: str, headers: Optional[dict] = None, session: Optional[requests.Session] = None) -> dict:
+    """用 Range: bytes=0-0 探测总大小与是否支持分段；不支持时 total 为 None。"""
+    http = session or requests
+    req_headers = _request_headers(headers)
+    req_headers["Range"] = "bytes=0-0"
+    with http.get(url, stream=True, timeout=30, headers=req_headers) as r:
+        r.raise_for_status()
+        if r.status_code != 206:
+            return {"total": None}
+        r.content  # 读完 1 字节响应体，连接可放回连接池
+        _, total = _parse_content_range(r.headers.get("Content-Range"))
+        return {"total": total, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+
+
+def _preallocate(f, size: int):
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            pass
+    f.truncate(size)
+
 
+def download_segmented(url: str, path: str, probe: dict, segments: int, retry: int = 2, headers: Optional[dict] = None,
+                       progress: Optional[Callable[..., Optional[float]]] = None, session: Optional[requests.Session] = None,
+                       info: Optional[dict] = None, monitor: Optional[Callable[[str, dict], None]] = None,
+                       buffer_size: int = COPY_BUFFER):
+    """把单个大文件切成 segments 段并发 Range 下载，直接按偏移写入预分配的 .part 文件。
 
-def append_log(log_file: str, data: dict):
+    probe 为 probe_range 的结果；每段在自身范围内重试并从已写位置续传。
+    第 0 段在调用线程执行，其余各段各占一个线程，并发额度由调用方负责申请。
+    info、monitor、buffer_size 同 download_file；各段乱序写入，SHA-256 在完成后补算一遍。
+    """
+    http = session or requests
+    total = probe["total"]
+    validator = probe.get("etag") or probe.get("last_modified")
+    part_path = path + ".part"
+    if progress:
+        # 先于预分配：调用方可在这里按总大小做磁盘空间准入
+        progress(-1, total)
+    ensure_dir(path)
     try:
-        ensure_dir(log_file)
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(json.dumps({"ts": __import__("time").time(), **data}, ensure_ascii=False) + "\n")
-    except Exception:
+        # 分段写入的 .part 有空洞：先删掉单连接下载留下的续传元数据，避免之后按它续传
+        _drop_part(part_path, part_path + ".json")
+        with open(part_path, "wb") as f:
+            _preallocate(f, total)
+    except FileNotFoundError:
+        forget_dir(path)
+        raise
+    progress_lock = threading.Lock()
+    step = -(-total // segments)
+    ranges = [(start, min(start + step, total) - 1) for start in range(0, total, step)]
+    errors = []
+    # 取消或任一段最终失败后置位：其余段不再重试、不再发起新请求
+    stop = threading.Event()
+
+    def abort(r):
+        errors.append("cancelled")
+        stop.set()
+        _abort_response(r)
+
+    def fetch(start: int, end: int):
+        pos = start
+        attempt = 0
+
+        def on_data(data):
+            nonlocal pos
+            pos += len(data)
+            if progress:
+                with progress_lock:
+                    wait = progress(len(data))
+                # 限速等待放在锁外，一段在等时其余段照常写入
+                if wait:
+                    time.sleep(wait)
+
+        with open(part_path, "r+b", buffering=buffer_size) as f:
+            while pos <= end and not stop.is_set():
+                try:
+                    req_headers = _request_headers(headers)
+                    req_headers["Range"] = f"bytes={pos}-{end}"
+                    if validator:
+                        req_headers["If-Range"] = validator
+                    sent = time.perf_counter()
+                    with http.get(url, stream=True, timeout=30, headers=req_headers) as r:
+                        if monitor:
+                            monitor("response", {"status": r.status_code, "ttfb": time.perf_counter() - sent,
+                                                 "abort": lambda: abort(r)})
+                        r.raise_for_status()
+                        got_start, got_total = _parse_content_range(r.headers.get("Content-Range"))
+                        if r.status_code != 206 or got_start != pos or got_total != total:
+                            raise Exception(f"segment range mismatch: {r.headers.get('Content-Range')}")
+                        f.seek(pos)
+                        _copy_body(r, f, end + 1 - pos, buffer_size, on_data)
+                    if pos <= end:
+                        raise Exception(f"segment incomplete: {pos - start}/{end + 1 - start} bytes")
+                except Exception as e:
+                    if str(e) == "cancelled":
+                        errors.append("cancelled")
+                        stop.set()
+                    if stop.is_set():
+                        return
+                    retry_after = retry_after_seconds(e)
+                    if monitor:
+                        monitor("error", {"reason": classify_error(e), "retry_after": retry_after})
+                    attempt += 1
+                    if attempt > retry:
+                        errors.append(str(e))
+                        stop.set()
+                        return
+                    stop.wait(backoff_delay(attempt - 1, retry_after=retry_after))
+
+    threads = [threading.Thread(target=fetch, args=rng, daemon=True) for rng in ranges[1:]]
+    for t in threads:
+        t.start()
+    fetch(*ranges[0])
+    for t in threads:
+        t.join()
+    if errors:
+        _drop_part(part_path, part_path + ".json")
+        return False, errors[0]
+    _commit_part(path)
+    if info is not None:
+        info.update(size=total, total=total, etag=probe.get("etag"), last_modified=probe.get("last_modified"),
+                    sha256=_hash_file(path).hexdigest())
+    return True, None
+
+
+class AsyncEngine:
+    """--engine async：所有传输作为协程跑在同一个事件循环线程上（aiohttp），
+    打开、写入、重命名等文件操作交给一个小线程池，事件循环只做网络读取与调度。"""
+
+    def __init__(self, write_workers: int = 4):
+        if aiohttp is None:
+            raise RuntimeError("--engine async 需要 aiohttp：pip install aiohttp")
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(write_workers, thread_name_prefix="async-write")
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-engine", daemon=True)
+        self._thread.start()
+        self.session = asyncio.run_coroutine_threadsafe(self._open_session(), self.loop).result()
+
+    async def _open_session(self):
+        # 并发由调度器控制，连接器不再设上限；与 SessionPool 一样不保存服务端下发的 Cookie
+        return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, ttl_dns_cache=300),
+                                     cookie_jar=aiohttp.DummyCookieJar(),
+                                     timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=30))
+
+    def start(self, coro, done: Callable[[], None]):
+        """从其他线程把协程交给事件循环执行，结束（含异常）后调用 done。"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        future.add_done_callback(lambda _: done())
+
+    def write(self, fn: Callable, *args):
+        """在文件线程池中执行阻塞的文件操作，返回可 await 的结果。"""
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def offload(self, fn: Callable, *args):
+        """在默认线程池中执行其他阻塞操作（去重 HEAD、校验等），不占用文件线程池。"""
+        return self.loop.run_in_executor(None, fn, *args)
+
+    def abort(self, response):
+        """线程安全地中断一个在途响应（取消条目用）。"""
+        self.loop.call_soon_threadsafe(response.close)
+
+    async def _shutdown(self):
+        # 在途传输直接取消：.part 残片保留，批次日志中仍为 running，下次启动时续传
+        tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.session.close()
+
+    def close(self):
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(5)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+
+def _http_error(url: str, status: int, reason: str, resp_headers) -> requests.HTTPError:
+    """把 aiohttp 的错误状态转成 requests.HTTPError，classify_error 与 Retry-After 处理保持不变。"""
+    response = requests.Response()
+    response.status_code = status
+    response.reason = reason
+    response.url = url
+    response.headers.update(resp_headers)
+    return requests.HTTPError(f"{status} Error: {reason} for url: {url}", response=response)
+
+
+def _write_chunk(f, hasher, data: bytes):
+    f.write(data)
+    if hasher:
+        hasher.update(data)
+
+
+def _close_part(f, preallocated: bool, total: Optional[int]) -> int:
+    size = f.tell()
+    if preallocated and size != total:
+        f.truncate(size)
+    f.close()
+    return size
+
+
+def _commit_part(path: str):
+    """完成下载：.part 改名为目标文件，删除续传元数据。所有成功路径都走这里。"""
+    part_path = path + ".part"
+    os.replace(part_path, path)
+    _drop_part(part_path, part_path + ".json")
+
+
+async def download_file_async(engine: AsyncEngine, url: str, path: str, headers: Optional[dict] = None,
+                              progress: Optional[Callable[..., Optional[float]]] = None, info: Optional[dict] = None,
+                              monitor: Optional[Callable[[str, dict], None]] = None,
+                              buffer_size: int = COPY_BUFFER, preallocate: bool = False):
+    """download_file 的事件循环版本，只做一次尝试（重试由 JobQueue 重新入队）。
+
+    .part 续传、info、monitor 与 progress 的约定与 download_file 相同；progress 返回正数时
+    表示限速需要等待的秒数，在事件循环上 await 而不阻塞线程。文件操作与 SHA-256 计算在 engine 的文件线程池中执行。
+    """
+    part_path = path + ".part"
+    meta_path = part_path + ".json"
+    try:
+        while True:
+            req_headers, meta, offset = await engine.write(_resume_request, path, headers)
+            sent = time.perf_counter()
+            async with engine.session.get(url, headers=req_headers) as r:
+                if monitor:
+                    monitor("response", {"status": r.status, "ttfb": time.perf_counter() - sent,
+                                         "abort": lambda: engine.abort(r)})
+                if r.status >= 400:
+                    raise _http_error(url, r.status, r.reason or "", r.headers)
+                plan = await engine.write(_open_part, url, path, r.status, r.headers, offset, meta)
+                if plan is None:
+                    # 续传校验失败：残片已丢弃，重新完整下载
+                    continue
+                mode, offset, total = plan
+                if progress:
+                    progress(-1, total, offset)
+                hasher = None
+                if info is not None:
+                    hasher = hashlib.sha256()
+                    if offset:
+                        await engine.write(_hash_file, part_path, hasher)
+                preallocated = preallocate and mode == "wb" and bool(total)
+                # 数据块由事件循环按到达大小交来，不再套一层大写缓冲，避免上千个在途文件各占一块
+                f = await engine.write(open, part_path, mode)
+                try:
+                    if preallocated:
+                        await engine.write(_preallocate, f, total)
+                    async for chunk in r.content.iter_chunked(buffer_size):
+                        await engine.write(_write_chunk, f, hasher, chunk)
+                        wait = progress(len(chunk)) if progress else None
+                        if wait:
+                            await asyncio.sleep(wait)
+                finally:
+                    size = await engine.write(_close_part, f, preallocated, total)
+                validators = {"etag": r.headers.get("ETag") or meta.get("etag"),
+                              "last_modified": r.headers.get("Last-Modified") or meta.get("last_modified")}
+            break
+        if total is not None and size != total:
+            raise Exception(f"incomplete download: {size}/{total} bytes")
+        await engine.write(_commit_part, path)
+        if info is not None:
+            info.update(validators, size=size, total=total, sha256=hasher.hexdigest())
+        return True, None
+    except Exception as e:
+        if isinstance(e, FileNotFoundError):
+            forget_dir(path)
+        # 与同步路径一致地归类为 requests 的超时/连接错误
+        if isinstance(e, asyncio.TimeoutError):
+            e = requests.exceptions.ReadTimeout(e)
+        elif isinstance(e, aiohttp.ClientError):
+            e = requests.exceptions.ConnectionError(e)
+        if monitor:
+            monitor("error", {"reason": classify_error(e), "retry_after": retry_after_seconds(e)})
+        if not os.path.exists(meta_path):
+            _drop_part(part_path, meta_path)
+        return False, str(e)
+
+
+class LogWriter:
+    """结构化日志写入器：调用方只把事件放进内存队列，后台线程批量追加到文件。
+
+    - 每 flush_interval 秒或攒够 batch_size 条写一次，文件句柄常驻；
+    - 文件超过 max_bytes 时轮转为 .1 ~ .backups，compress 为真时旧段压缩为 .gz；
+    - close() 会把队列中剩余的日志全部写完；
+    - index 不为空时，每写一行同步追加到旁路索引（见 LogIndex）。
+    """
+
+    def __init__(self, log_file: str, flush_interval: float = 0.5, batch_size: int = 500,
+                 max_bytes: int = 50 * 1024 * 1024, backups: int = 5, compress: bool = False,
+                 index: Optional["LogIndex"] = None):
+        self.log_file = log_file
+        self.index = index
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._flush_requested = False
+        self._flushed = 0
+        self._queued = 0
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def write(self, data: dict):
+        with self._cond:
+            if self._closed:
+                return
+            self._pending.append((time.time(), data))
+            self._queued += 1
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None):
+        """等待此前写入的事件全部落盘。"""
+        with self._cond:
+            target = self._queued
+            self._flush_requested = True
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._flushed >= target or not self._thread.is_alive(), timeout)
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        if self.index:
+            self.index.load()
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not (self._closed or self._flush_requested or len(self._pending) >= self.batch_size):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._pending = self._pending, deque()
+                self._flush_requested = False
+                closed = self._closed
+            if batch:
+                self._write_batch(batch)
+            with self._cond:
+                self._flushed += len(batch)
+                self._cond.notify_all()
+            if closed and not batch:
+                break
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.index:
+            self.index.close()
+
+    def _write_batch(self, batch):
+        lines = []
+        entries = []
+        for ts, data in batch:
+            if "ts" in data:
+                # 行首 ts 始终是服务端时间（索引按它二分）；客户端自带的 ts 改名保留
+                data = dict(data)
+                data["client_ts"] = data.pop("ts")
+            try:
+                lines.append((json.dumps({"ts": ts, **data}, ensure_ascii=False) + "\n").encode("utf-8"))
+            except (TypeError, ValueError):
+                continue
+            entries.append((ts, data))
+        try:
+            if self._file is None:
+                ensure_dir(self.log_file)
+                self._file = open(self.log_file, "ab")
+            offset = self._file.tell()
+            self._file.write(b"".join(lines))
+            self._file.flush()
+            if self.index:
+                self.index.extend(offset, lines, entries)
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+        except FileNotFoundError:
+            forget_dir(self.log_file)
+        except OSError:
+            pass
+
+    def _segment(self, n: int) -> str:
+        name = f"{self.log_file}.{n}"
+        return name + ".gz" if self.compress else name
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.index:
+            # 未压缩时 .1 段的索引随之保留，/logs 仍能查到上一段
+            self.index.rotate(self._shift_segments, self.backups > 0 and not self.compress)
+        else:
+            self._shift_segments()
+        if self.backups <= 0 or not self.compress:
+            return
+        rotated = f"{self.log_file}.1.tmp"
+        with open(rotated, "rb") as src, gzip.open(self._segment(1), "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(rotated)
+
+    def _shift_segments(self):
+        if self.backups <= 0:
+            os.remove(self.log_file)
+            return
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(self._segment(n)):
+                os.replace(self._segment(n), self._segment(n + 1))
+        # 压缩在改名之后、不持有索引锁时进行
+        os.replace(self.log_file, self._segment(1) if not self.compress else f"{self.log_file}.1.tmp")
+
+    def history_truncated(self) -> bool:
+        """是否还有 /logs 查不到的更早日志段（.1.gz 或 .2 及以后）。"""
+        first = 1 if self.compress else 2
+        return any(os.path.exists(self._segment(n)) for n in range(first, self.backups + 1))
+
+
+def _log_fields(data: dict) -> tuple:
+    """取出日志行的 event 与 sku（扩展上报的 sku 在 data 字段里）。"""
+    event = data.get("event")
+    sku = data.get("sku")
+    if sku is None and isinstance(data.get("data"), dict):
+        sku = data["data"].get("sku")
+    return ("" if event is None else str(event)), ("" if sku is None else str(sku))
+
+
+class LogIndex:
+    """jdvideo.log 的旁路索引（<log>.idx），随日志写入增量追加。
+
+    每行日志在 .idx 中对应一行 "偏移\t长度\tts\tevent\tsku"；内存中保存按行号排列的
+    偏移/长度/时间戳数组，以及 event、sku 到行号的倒排表。查询时先在索引里选出行号，
+    再按偏移 seek 读取对应日志行，不扫描整个日志文件。
+
+    索引当前日志文件与最近一个未压缩的轮转段（<log>.1，索引为 <log>.1.idx，由 previous 持有）；
+    行号先排上一段、再排当前文件，轮转后旧的 cursor 失效。更早的段不索引。
+    """
+
+    def __init__(self, log_file: str):
+        self.log_file = log_file
+        self.index_file = log_file + ".idx"
+        self._lock = threading.Lock()
+        self._file = None
+        self.previous = None
+        self._clear()
+
+    def _clear(self):
+        self.offsets = array("q")
+        self.lengths = array("l")
+        self.ts = array("d")
+        self.event_ids = array("l")
+        self.sku_ids = array("l")
+        self._names = {}
+        self.postings = {}
+
+    def _intern(self, kind: str, value: str) -> int:
+        key = (kind, value)
+        ident = self._names.get(key)
+        if ident is None:
+            ident = self._names[key] = len(self._names)
+            self.postings[ident] = array("l")
+        return ident
+
+    def _add(self, offset: int, length: int, ts: float, event: str, sku: str):
+        row = len(self.offsets)
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.ts.append(ts)
+        event_id = self._intern("event", event)
+        sku_id = self._intern("sku", sku)
+        self.event_ids.append(event_id)
+        self.sku_ids.append(sku_id)
+        self.postings[event_id].append(row)
+        self.postings[sku_id].append(row)
+
+    @staticmethod
+    def _clean(value: str) -> str:
+        return value.replace("\t", " ").replace("\n", " ")
+
+    def load(self):
+        """读取已有 .idx，并从索引末尾补扫日志中尚未索引的行；索引与日志不一致时整体重建。"""
+        with self._lock:
+            self._clear()
+            ensure_dir(self.index_file)
+            self._file = open(self.index_file, "a+b")
+            self._file.seek(0)
+            valid = 0
+            for line in self._file:
+                parts = line.decode("utf-8", "replace").rstrip("\n").split("\t")
+                if not line.endswith(b"\n") or len(parts) != 5:
+                    break
+                try:
+                    self._add(int(parts[0]), int(parts[1]), float(parts[2]), parts[3], parts[4])
+                except ValueError:
+                    break
+                valid += len(line)
+            end = self.offsets[-1] + self.lengths[-1] if self.offsets else 0
+            try:
+                size = os.path.getsize(self.log_file)
+            except OSError:
+                size = 0
+            if end > size:
+                # 日志被外部截断或替换过
+                self._clear()
+                end = valid = 0
+            # 丢掉崩溃时写了一半的索引行
+            self._file.truncate(valid)
+            if end < size:
+                self._catch_up(end)
+            if self.previous is None and os.path.exists(self.log_file + ".1"):
+                self.previous = LogIndex(self.log_file + ".1")
+                self.previous.load()
+
+    def _catch_up(self, offset: int):
+        # 调用方需持有 self._lock
+        with open(self.log_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    data = {}
+                if not isinstance(data, dict):
+                    data = {}
+                try:
+                    ts = float(data.get("ts") or 0)
+                except (TypeError, ValueError):
+                    # 损坏的 ts 沿用上一行，保持时间戳数组有序
+                    ts = self.ts[-1] if self.ts else 0.0
+                self._append(offset, len(line), ts, *_log_fields(data))
+                offset += len(line)
+        self._file.flush()
+
+    def _append(self, offset: int, length: int, ts: float, event: str, sku: str):
+        event, sku = self._clean(event), self._clean(sku)
+        self._add(offset, length, ts, event, sku)
+        self._file.write(f"{offset}\t{length}\t{ts:.6f}\t{event}\t{sku}\n".encode("utf-8"))
+
+    def extend(self, offset: int, lines: list, entries: list):
+        """LogWriter 写完一批后调用：lines 为已编码的日志行，entries 为对应的 (ts, data)。"""
+        with self._lock:
+            if self._file is None:
+                return
+            for line, (ts, data) in zip(lines, entries):
+                self._append(offset, len(line), ts, *_log_fields(data))
+                offset += len(line)
+            self._file.flush()
+
+    def rotate(self, rename: Callable[[], None], keep: bool):
+        """日志轮转：在持有索引锁时执行 rename（日志段改名），keep 为真时当前索引改名为
+        <log>.1.idx 继续作为上一段可查，否则丢弃；当前文件的索引清空重建。"""
+        with self._lock:
+            if self.previous:
+                self.previous.close()
+                self.previous = None
+            rename()
+            previous_index = self.log_file + ".1.idx"
+            if keep and self._file:
+                self._file.close()
+                os.replace(self.index_file, previous_index)
+                previous = LogIndex(self.log_file + ".1")
+                for name in ("offsets", "lengths", "ts", "event_ids", "sku_ids", "_names", "postings"):
+                    setattr(previous, name, getattr(self, name))
+                self.previous = previous
+                self._clear()
+                self._file = open(self.index_file, "a+b")
+                return
+            try:
+                os.remove(previous_index)
+            except FileNotFoundError:
+                pass
+            self._clear()
+            if self._file:
+                self._file.truncate(0)
+
+    def first_ts(self) -> Optional[float]:
+        """可查询的最早一行的时间戳。"""
+        with self._lock:
+            for part in (self.previous, self):
+                if part is not None and len(part.ts):
+                    return part.ts[0]
+        return None
+
+    def query(self, event: Optional[str] = None, sku: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, cursor: int = 0, limit: int = 100) -> tuple:
+        """返回 (日志对象列表, next_cursor)；cursor 为行号，没有更多结果时 next_cursor 为 None。"""
+        with self._lock:
+            previous = self.previous
+            if previous is None:
+                return self._query(event, sku, since, until, cursor, limit)
+            with previous._lock:
+                skip = len(previous.offsets)
+                items = []
+                if cursor < skip:
+                    items, next_cursor = previous._query(event, sku, since, until, cursor, limit)
+                    if next_cursor is not None:
+                        return items, next_cursor
+                    if len(items) == limit:
+                        return items, skip
+            more, next_cursor = self._query(event, sku, since, until, max(0, cursor - skip), limit - len(items))
+            return items + more, None if next_cursor is None else next_cursor + skip
+
+    def _query(self, event: Optional[str], sku: Optional[str], since: Optional[float], until: Optional[float],
+               cursor: int, limit: int) -> tuple:
+        # 调用方需持有 self._lock
+        start = max(cursor, bisect_left(self.ts, since) if since is not None else 0)
+        stop = bisect_right(self.ts, until) if until is not None else len(self.ts)
+        filters = []
+        for kind, value in (("event", event), ("sku", sku)):
+            if value is not None:
+                ident = self._names.get((kind, value))
+                if ident is None:
+                    return [], None
+                filters.append((kind, ident))
+        if filters:
+            kind, ident = min(filters, key=lambda f: len(self.postings[f[1]]))
+            candidates = self.postings[ident]
+            candidates = candidates[bisect_left(candidates, start):]
+        else:
+            candidates = range(start, stop)
+        rows = []
+        next_cursor = None
+        for row in candidates:
+            if row >= stop:
+                break
+            if all((self.event_ids if k == "event" else self.sku_ids)[row] == i for k, i in filters):
+                if len(rows) == limit:
+                    next_cursor = row
+                    break
+                rows.append(row)
+        items = []
+        if rows:
+            with open(self.log_file, "rb") as f:
+                for row in rows:
+                    f.seek(self.offsets[row])
+                    try:
+                        items.append(json.loads(f.read(self.lengths[row])))
+                    except ValueError:
+                        continue
+        return items, next_cursor
+
+    def close(self):
+        with self._lock:
+            if self.previous:
+                self.previous.close()
+                self.previous = None
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def normalize_video_url(url: str) -> str:
+    """去重键：小写主机 + 路径，去掉查询串与片段（签名参数每次不同）。"""
+    parsed = urlparse(url)
+    return f"{parsed.netloc.lower()}{parsed.path}"
+
+
+# linux/fs.h 中的 FICLONE = _IOW(0x94, 9, int)：让两个文件共享数据块（写时复制）
+FICLONE = 0x40049409
+PLACE_METHODS = ("link", "reflink", "copy")
+
+
+def _reflink(src: str, dst: str) -> bool:
+    """在支持的文件系统（btrfs/XFS 等）上把 dst 创建为 src 的 reflink；不支持时删除 dst 并返回 False。"""
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    try:
+        with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+        return False
+
+
+def place_copy(src: str, dst: str, allow_copy: bool = True, prefer: str = "link") -> Optional[str]:
+    """把已存在的 src 放到 dst，不经过网络：按 硬链接 -> reflink -> 本地复制 的顺序尝试，
+    prefer 指定从哪一种开始（"reflink" 与 "copy" 得到的是互不影响的独立文件）。
+
+    返回所用方式（"link"/"reflink"/"copy"）；allow_copy 为 False 且无法链接时不改动 dst，返回 None。
+    """
+    try:
+        return _place_copy(src, dst, allow_copy, prefer)
+    except FileNotFoundError:
+        # 目标目录可能在运行中被删除：清掉目录缓存，重新创建后再试一次
+        forget_dir(dst)
+        return _place_copy(src, dst, allow_copy, prefer)
+
+
+def _place_copy(src: str, dst: str, allow_copy: bool, prefer: str) -> Optional[str]:
+    ensure_dir(dst)
+    tmp = dst + ".link"
+    try:
+        os.remove(tmp)
+    except FileNotFoundError:
         pass
+    method = None
+    for candidate in PLACE_METHODS[PLACE_METHODS.index(prefer):]:
+        if candidate == "link":
+            try:
+                os.link(src, tmp)
+                method = "link"
+                break
+            except FileNotFoundError:
+                # 源文件在时是目标目录不见了，交给 place_copy 重建
+                if os.path.exists(src):
+                    raise
+                continue
+            except OSError:
+                continue
+        if candidate == "reflink" and _reflink(src, tmp):
+            method = "reflink"
+            break
+        if candidate == "copy" and allow_copy:
+            # copyfile 在 Linux 上走 sendfile，数据不经过用户态
+            shutil.copyfile(src, tmp)
+            method = "copy"
+    if method is None:
+        return None
+    os.replace(tmp, dst)
+    return method
+
+
+class DedupeIndex:
+    """持久化去重索引（追加写 JSON Lines，后写覆盖前写）。
+
+    每条记录对应一个已下载文件：path、url（规范化）、sku、size、etag、last_modified、sha256；
+    内存中按 path / url / sku / sha256 四路索引。
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self._lock = threading.Lock()
+        self.by_path = {}
+        self.by_url = {}
+        self.by_sku = {}
+        self.by_hash = {}
+        self._lines = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        continue
+                    self._lines += 1
+        except FileNotFoundError:
+            return
+        if self._lines > 2 * len(self.by_path) + 100:
+            self._compact()
+
+    def _apply(self, entry: dict):
+        self.by_path[entry["path"]] = entry
+        for key, index in (("url", self.by_url), ("sku", self.by_sku), ("sha256", self.by_hash)):
+            if entry.get(key):
+                index[entry[key]] = entry["path"]
+
+    def _compact(self):
+        ensure_dir(self.index_file)
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            for entry in self.by_path.values():
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.index_file)
+        self._lines = len(self.by_path)
+
+    def _existing(self, path: Optional[str]) -> Optional[dict]:
+        # 调用方需持有 self._lock；文件已被删除或大小变化的记录视为失效
+        entry = self.by_path.get(path) if path else None
+        if not entry:
+            return None
+        try:
+            if os.path.getsize(path) != entry["size"]:
+                return None
+        except OSError:
+            return None
+        return entry
+
+    def lookup(self, url: str, sku: str) -> tuple:
+        """返回 (记录, 命中方式)；命中方式为 "url" 或 "sku"，未命中为 (None, None)。"""
+        with self._lock:
+            entry = self._existing(self.by_url.get(normalize_video_url(url)))
+            if entry:
+                return entry, "url"
+            entry = self._existing(self.by_sku.get(sku))
+            if entry:
+                return entry, "sku"
+            return None, None
+
+    def lookup_hash(self, sha256: str) -> Optional[dict]:
+        with self._lock:
+            return self._existing(self.by_hash.get(sha256))
+
+    def record(self, path: str, url: str, sku: str, info: dict):
+        entry = {"path": path, "url": normalize_video_url(url), "sku": sku, "size": info.get("size"),
+                 "etag": info.get("etag"), "last_modified": info.get("last_modified"),
+                 "sha256": info.get("sha256"), "ts": time.time()}
+        with self._lock:
+            self._apply(entry)
+            for _ in range(2):
+                try:
+                    ensure_dir(self.index_file)
+                    with open(self.index_file, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    self._lines += 1
+                    return
+                except FileNotFoundError:
+                    # 索引目录在运行中被删除：清掉目录缓存后重建一次
+                    forget_dir(self.index_file)
+                except OSError:
+                    return
+
+
+def verify_unchanged(url: str, entry: dict, matched_by: str, headers: Optional[dict] = None,
+                     session: Optional[requests.Session] = None) -> bool:
+    """用一次条件 HEAD 确认远端内容与索引记录一致。
+
+    304 视为一致；否则比较 ETag，没有 ETag 时（仅限 URL 命中）比较大小与 Last-Modified。
+    SKU 命中的记录必须有 ETag 匹配，避免同一 SKU 的不同视频被误判。
+    """
+    http = session or requests
+    req_headers = _request_headers(headers)
+    if entry.get("etag"):
+        req_headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        req_headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        r = http.head(url, timeout=15, headers=req_headers, allow_redirects=True)
+    except requests.RequestException:
+        return False
+    if r.status_code == 304:
+        return matched_by == "url" or bool(entry.get("etag"))
+    if r.status_code != 200:
+        return False
+    etag = r.headers.get("ETag")
+    if etag or entry.get("etag"):
+        return etag == entry.get("etag")
+    if matched_by != "url":
+        return False
+    length = r.headers.get("Content-Length")
+    return (length is not None and int(length) == entry.get("size")
+            and r.headers.get("Last-Modified") == entry.get("last_modified"))
+
+
+def check_mp4(path: str) -> Optional[str]:
+    """检查 MP4 顶层 box 结构：box 必须恰好铺满整个文件且包含 moov；正常返回 None，否则返回原因。
+
+    只读取各 box 头部（每个 box 一次 seek），不读正文。
+    """
+    size = os.path.getsize(path)
+    seen = set()
+    pos = 0
+    with open(path, "rb") as f:
+        while pos < size:
+            f.seek(pos)
+            header = f.read(16)
+            if len(header) < 8:
+                return f"truncated box header at {pos}"
+            box_size, box_type = struct.unpack(">I4s", header[:8])
+            name = box_type.decode("latin-1")
+            if box_size == 1:
+                if len(header) < 16:
+                    return f"truncated box header at {pos}"
+                box_size = struct.unpack(">Q", header[8:])[0]
+            elif box_size == 0:
+                # 0 表示该 box 一直延续到文件末尾
+                box_size = size - pos
+            if box_size < 8:
+                return f"invalid {name!r} box size {box_size} at {pos}"
+            if pos + box_size > size:
+                return f"truncated {name!r} box at {pos}: {size - pos}/{box_size} bytes"
+            seen.add(box_type)
+            pos += box_size
+    if b"moov" not in seen:
+        return "moov atom missing"
+    return None
+
+
+def verify_download(path: str, info: dict, mode: str) -> Optional[str]:
+    """下载后校验：文件大小须与写入字节数及 Content-Length 一致；mode 为 mp4 时再检查容器结构。
+    通过返回 None，否则返回原因。"""
+    size = os.path.getsize(path)
+    if info.get("size") is not None and size != info["size"]:
+        return f"size {size} != written {info['size']}"
+    if info.get("total") is not None and size != info["total"]:
+        return f"size {size} != content-length {info['total']}"
+    if mode == "mp4":
+        return check_mp4(path)
+    return None
+
+
+class VerifyManifest:
+    """每个下载目录一份校验清单 <目录>/.jdvideo-manifest.jsonl（追加写，后写覆盖前写）。
+
+    每条记录对应一个校验通过的文件：name、url（规范化）、size、mtime_ns、sha256、checks。
+    文件仍在且大小、修改时间未变时，之后提交同一 URL 到同一路径可直接跳过下载。
+    """
+
+    FILE_NAME = ".jdvideo-manifest.jsonl"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    def _entries(self, directory: str) -> dict:
+        # 调用方需持有 self._lock；每个目录首次访问时加载
+        entries = self._dirs.get(directory)
+        if entries is None:
+            entries = self._dirs[directory] = {}
+            manifest_file = os.path.join(directory, self.FILE_NAME)
+            lines = 0
+            try:
+                with open(manifest_file, "r", encoding="utf-8") as f:
+                    for line in f:
+                        lines += 1
+                        try:
+                            entry = json.loads(line)
+                            entries[entry["name"]] = entry
+                        except (ValueError, KeyError, TypeError):
+                            continue
+            except OSError:
+                pass
+            if lines > 2 * len(entries) + 100:
+                try:
+                    with open(manifest_file + ".tmp", "w", encoding="utf-8") as f:
+                        for entry in entries.values():
+                            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                    os.replace(manifest_file + ".tmp", manifest_file)
+                except OSError:
+                    pass
+        return entries
+
+    def lookup(self, path: str, url: str) -> Optional[dict]:
+        directory, name = os.path.split(path)
+        with self._lock:
+            entry = self._entries(directory).get(name)
+        if not entry or entry.get("url") != normalize_video_url(url):
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != entry.get("size") or st.st_mtime_ns != entry.get("mtime_ns"):
+            return None
+        return entry
+
+    def record(self, path: str, url: str, info: dict, checks: str):
+        directory, name = os.path.split(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        entry = {"name": name, "url": normalize_video_url(url), "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                 "sha256": info.get("sha256"), "checks": checks, "ts": time.time()}
+        with self._lock:
+            self._entries(directory)[name] = entry
+            try:
+                with open(os.path.join(directory, self.FILE_NAME), "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError:
+                pass
+
+
+class JobJournal:
+    """批次日志（SQLite，WAL 模式）：记录每个批次的条目与状态变化，进程重启后据此恢复未完成的条目。
+
+    jobs/items 在提交时写入一次；transitions 只追加，每次状态变化一行，以最后一行为准。
+    批次完成后整批删除，日志只保留在途的批次。写入失败只影响恢复，不影响下载本身。
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, created REAL, target TEXT, sub TEXT, segments INTEGER,"
+        " priority INTEGER DEFAULT 0, dests TEXT)",
+        "CREATE TABLE IF NOT EXISTS items (job TEXT, idx INTEGER, sku TEXT, title TEXT, url TEXT, headers TEXT,"
+        " segments INTEGER, priority INTEGER DEFAULT 0, dests TEXT, PRIMARY KEY (job, idx))",
+        "CREATE TABLE IF NOT EXISTS transitions (seq INTEGER PRIMARY KEY, job TEXT, idx INTEGER, state TEXT,"
+        " attempts INTEGER, error TEXT, ts REAL)",
+        "CREATE INDEX IF NOT EXISTS transitions_job ON transitions (job)",
+    )
+    # 旧版本建的表缺少的列
+    MIGRATIONS = (("priority", "INTEGER DEFAULT 0"), ("dests", "TEXT"))
+    # 登录凭据不落盘：根目录可能在共享盘上，恢复的条目不带这些请求头下载
+    SECRET_HEADERS = ("cookie", "authorization")
+
+    def __init__(self, db_file: str):
+        # 只在启动时执行一次，不依赖目录缓存，直接确认目录存在
+        forget_dir(db_file)
+        ensure_dir(db_file)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_file, check_same_thread=False)
+        # 只允许当前用户读写；WAL 与 shm 文件由 SQLite 按数据库文件的权限创建
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.chmod(db_file + suffix, 0o600)
+            except OSError:
+                pass
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL 下 NORMAL 只在检查点时 fsync；断电可能丢最后几次状态变化，重放时按未完成处理
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for stmt in self.SCHEMA:
+                self._conn.execute(stmt)
+            for table in ("jobs", "items"):
+                columns = [row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")]
+                for column, decl in self.MIGRATIONS:
+                    if column not in columns:
+                        self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+    def _write(self, fn: Callable[[sqlite3.Connection], None]):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                with self._conn:
+                    fn(self._conn)
+            except sqlite3.Error:
+                pass
+
+    def add_job(self, job: "Job", segments: int):
+        now = time.time()
+
+        def write(conn):
+            conn.execute("INSERT INTO jobs (id, created, target, sub, segments, priority, dests)"
+                         " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (job.id, job.created, job.target_dir, job.sub_dir, segments, job.priority,
+                          json.dumps(job.destinations, ensure_ascii=False)))
+            conn.executemany("INSERT INTO items (job, idx, sku, title, url, headers, segments, priority, dests)"
+                             " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+                                 (job.id, it["index"], it["sku"], it["title"], it["url"],
+                                  json.dumps(self._public_headers(it.get("headers")), ensure_ascii=False),
+                                  it.get("segments") or 0,
+                                  it["priority"], json.dumps(it.get("destinations"), ensure_ascii=False))
+                                 for it in job.items])
+            conn.executemany("INSERT INTO transitions (job, idx, state, attempts, error, ts) VALUES (?, ?, ?, ?, ?, ?)",
+                             [(job.id, it["index"], it["state"], it["attempts"], it["error"], now) for it in job.items])
+        self._write(write)
+
+    @classmethod
+    def _public_headers(cls, headers: Optional[dict]) -> dict:
+        return {k: v for k, v in (headers or {}).items() if str(k).lower() not in cls.SECRET_HEADERS}
+
+    def transition(self, job_id: str, it: dict):
+        self._write(lambda conn: conn.execute(
+            "INSERT INTO transitions (job, idx, state, attempts, error, ts) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, it["index"], it["state"], it["attempts"], it["error"], time.time())))
+
+    def finish(self, job_id: str):
+        def write(conn):
+            for table, column in (("transitions", "job"), ("items", "job"), ("jobs", "id")):
+                conn.execute(f"DELETE FROM {table} WHERE {column} = ?", (job_id,))
+        self._write(write)
+
+    def unfinished(self) -> list:
+        """返回 [(批次字段 dict, 原始条目列表, {idx: 最后状态 dict})]，按提交时间排序。"""
+        result = []
+        with self._lock:
+            for job_id, created, target, sub, segments, priority, dests in self._conn.execute(
+                    "SELECT id, created, target, sub, segments, priority, dests FROM jobs ORDER BY created").fetchall():
+                items = [{"sku": sku, "title": title, "videoUrl": url, "headers": json.loads(headers or "{}"),
+                          "segments": item_segments, "priority": item_priority,
+                          "destinations": json.loads(item_dests or "null")}
+                         for sku, title, url, headers, item_segments, item_priority, item_dests in self._conn.execute(
+                             "SELECT sku, title, url, headers, segments, priority, dests FROM items"
+                             " WHERE job = ? ORDER BY idx", (job_id,))]
+                states = {}
+                for idx, state, attempts, error in self._conn.execute(
+                        "SELECT idx, state, attempts, error FROM transitions WHERE job = ? ORDER BY seq", (job_id,)):
+                    states[idx] = {"state": state, "attempts": attempts, "error": error}
+                job = {"id": job_id, "created": created, "target": target, "sub": sub, "segments": segments,
+                       "priority": priority or 0, "destinations": json.loads(dests or "[]")}
+                result.append((job, items, states))
+        return result
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class EventBus:
+    """进度事件广播：每个 SSE 连接一个有界队列，消费过慢时丢弃最旧的事件。"""
+
+    def __init__(self, backlog: int = 1000):
+        self.backlog = backlog
+        self._subscribers = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+    def subscribe(self, job_id: Optional[str] = None) -> "queue.Queue":
+        q = queue.Queue(self.backlog)
+        with self._lock:
+            if self._closed:
+                q.put(None)
+            self._subscribers[q] = job_id
+        return q
+
+    def unsubscribe(self, q: "queue.Queue"):
+        with self._lock:
+            self._subscribers.pop(q, None)
+
+    def publish(self, event: dict):
+        if not self._subscribers:
+            return
+        with self._lock:
+            targets = [q for q, job_id in self._subscribers.items() if job_id is None or job_id == event.get("job", event.get("id"))]
+        for q in targets:
+            self._offer(q, event)
+
+    @staticmethod
+    def _offer(q: "queue.Queue", event):
+        while True:
+            try:
+                q.put_nowait(event)
+                return
+            except queue.Full:
+                try:
+                    q.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def close(self):
+        """通知所有订阅者结束（放入 None）。"""
+        with self._lock:
+            self._closed = True
+            targets = list(self._subscribers)
+        for q in targets:
+            self._offer(q, None)
+
+
+PRIORITIES = {"low": -1, "normal": 0, "high": 1}
+
+
+def parse_priority(value, default: int = 0) -> int:
+    """优先级可为 low/normal/high 或整数（越大越先执行）；无法解析时抛出 ValueError。"""
+    if value is None or value == "":
+        return default
+    if isinstance(value, str) and value.strip().lower() in PRIORITIES:
+        return PRIORITIES[value.strip().lower()]
+    return int(value)
+
+
+def parse_segments(value) -> int:
+    """分段数为非负整数，缺省为 0（沿用服务端默认）；无法解析时抛出 ValueError。"""
+    if value is None or value == "":
+        return 0
+    segments = int(value)
+    if segments < 0:
+        raise ValueError("segments must not be negative")
+    return segments
+
+
+def parse_destinations(value, sub_dir: str, root_dir: str) -> list:
+    """额外的保存位置：列表，每项为目标目录字符串或 {"target_dir", "sub_dir"}（sub_dir 缺省沿用批次的）。
+    返回规范化后的 [[target_dir, sub_dir], ...]；格式不对时抛出 ValueError。"""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise ValueError("destinations must be a list")
+    result = []
+    for dest in value:
+        if isinstance(dest, str):
+            target, sub = dest, sub_dir
+        elif isinstance(dest, dict):
+            target, sub = dest.get("target_dir"), dest.get("sub_dir", sub_dir)
+        else:
+            raise ValueError("invalid destination")
+        if not target or not isinstance(target, str) or not isinstance(sub or "", str):
+            raise ValueError("invalid destination")
+        result.append([normalize_root(target, root_dir), sub or ""])
+    return result
+
+
+class Job:
+    """一次 /download 提交的批次；items 中每项记录 state（queued/running/ok/fail/cancelled）与已下载字节数。"""
+
+    def __init__(self, items: list, target_dir: str, sub_dir: str, segments: int = 0, priority: int = 0,
+                 destinations: Optional[list] = None):
+        """destinations 为 parse_destinations 的结果：每个条目下载一次后再放到这些位置；
+        单个 item 的 destinations 覆盖批次的值。"""
+        self.id = uuid.uuid4().hex[:12]
+        self.created = time.time()
+        self.finished = None
+        self.remaining = 0
+        self.target_dir = target_dir
+        self.sub_dir = sub_dir
+        self.priority = priority
+        self.destinations = destinations or []
+        self.items = []
+        for index, item in enumerate(items):
+            sku = item.get("sku") or "unknown"
+            title = item.get("title") or "video"
+            url = item.get("videoUrl")
+            # 条目发布后不再增删键：处理线程会并发遍历条目生成快照
+            entry = {"index": index, "sku": sku, "title": title, "url": url,
+                     "path": None, "state": "queued", "bytes": 0, "total": None, "error": None, "dedupe": None,
+                     "verified": None, "priority": parse_priority(item.get("priority"), priority),
+                     "attempts": 0, "started": None, "fetched": False,
+                     "held": 0.0}
+            if url:
+                entry["path"] = build_path(target_dir, sub_dir, sku, title)
+                entry["headers"] = item.get("headers") or {}
+                entry["segments"] = parse_segments(item.get("segments")) or segments or 0
+                entry["destinations"] = item.get("destinations")
+                dests = self.destinations if entry["destinations"] is None else entry["destinations"]
+                paths = OrderedDict.fromkeys(build_path(t, sub, sku, title) for t, sub in dests)
+                paths.pop(entry["path"], None)
+                # 每个额外位置的放置方式（link/reflink/copy），完成后填入
+                entry["copies"] = [{"path": path, "method": None} for path in paths] or None
+            else:
+                entry["state"] = "fail"
+                entry["error"] = "missing_url"
+            self.items.append(entry)
+
+    @property
+    def state(self) -> str:
+        if self.finished:
+            return "done"
+        if any(it["state"] != "queued" for it in self.items if it["url"]):
+            return "running"
+        return "queued"
+
+    def snapshot(self, with_items: bool = True) -> dict:
+        counts = {"queued": 0, "running": 0, "ok": 0, "fail": 0, "cancelled": 0}
+        for it in self.items:
+            counts[it["state"]] += 1
+        data = {
+            "id": self.id,
+            "state": self.state,
+            "created": self.created,
+            "finished": self.finished,
+            "target": self.target_dir,
+            "sub": self.sub_dir,
+            "priority": self.priority,
+            "destinations": [{"target": t, "sub": sub} for t, sub in self.destinations],
+            "total": len(self.items),
+            "success": counts["ok"],
+            "counts": counts,
+            "bytes": sum(it["bytes"] for it in self.items),
+        }
+        if with_items:
+            data["items"] = [
+                {k: v for k, v in it.items()
+                 if k not in ("headers", "segments", "started", "destinations", "fetched", "held") and v is not None}
+                for it in self.items
+            ]
+        return data
+
+
+def _fmt_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _ShardedMetric:
+    """按线程分片的指标基类：记录时只改当前线程自己的格子，不加锁；采集时汇总。
+
+    线程结束后其格子在下次登记或采集时折叠进 _base，避免每请求一线程时无限增长。
+    """
+
+    def __init__(self, name: str, help_text: str, label: str = ""):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._local = threading.local()
+        self._cells = []
+        self._base = self._new_cell()
+        self._lock = threading.Lock()
+
+    def _new_cell(self):
+        raise NotImplementedError
+
+    def _merge(self, into, cell):
+        raise NotImplementedError
+
+    def _cell(self):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = self._new_cell()
+            with self._lock:
+                if len(self._cells) >= 64:
+                    self._fold()
+                self._cells.append((threading.current_thread(), cell))
+        return cell
+
+    def _fold(self):
+        # 调用方需持有 self._lock
+        alive = []
+        for thread, cell in self._cells:
+            if thread.is_alive():
+                alive.append((thread, cell))
+            else:
+                self._merge(self._base, cell)
+        self._cells = alive
+
+    def collect(self):
+        """汇总所有线程的格子，返回一个新格子（Counter 为 标签值 -> 计数，Histogram 为各桶计数 + [sum, count]）。"""
+        with self._lock:
+            self._fold()
+            total = self._new_cell()
+            self._merge(total, self._base)
+            for _, cell in self._cells:
+                self._merge(total, cell)
+        return total
+
+
+class Counter(_ShardedMetric):
+    def _new_cell(self):
+        return defaultdict(float)
+
+    def _merge(self, into, cell):
+        for key, value in list(cell.items()):
+            into[key] += value
+
+    def inc(self, value: float = 1, label_value: str = ""):
+        self._cell()[label_value] += value
+
+    def value(self, label_value: str = "") -> float:
+        """某个标签值（无标签时为 ""）的当前累计值。"""
+        return self.collect().get(label_value, 0.0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        values = self.collect()
+        if not self.label:
+            lines.append(f"{self.name} {_fmt_value(values.get('', 0.0))}")
+        for key, value in sorted(values.items()):
+            if self.label and key:
+                lines.append(f'{self.name}{{{self.label}="{key}"}} {_fmt_value(value)}')
+        return lines
+
+
+class Histogram(_ShardedMetric):
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help_text)
+
+    def _new_cell(self):
+        # 各桶计数 + [sum, count]
+        return [0] * len(self.buckets) + [0.0, 0]
+
+    def _merge(self, into, cell):
+        for i, value in enumerate(list(cell)):
+            into[i] += value
+
+    def observe(self, value: float):
+        cell = self._cell()
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            cell[i] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        cell = self.collect()
+        cumulative = 0
+        for bound, count in zip(self.buckets, cell):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound:g}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cell[-1]}')
+        lines.append(f"{self.name}_sum {_fmt_value(cell[-2])}")
+        lines.append(f"{self.name}_count {cell[-1]}")
+        return lines
+
+
+class Metrics:
+    """/metrics 暴露的指标（Prometheus 文本格式）；队列深度等瞬时值在采集时由 gauges 回调读取。"""
+
+    def __init__(self):
+        self.bytes = Counter("jdvideo_downloaded_bytes_total", "Bytes written to disk by downloads.")
+        self.items = Counter("jdvideo_items_total", "Finished items by result.", "result")
+        self.retries = Counter("jdvideo_retries_total", "Download attempts requeued for retry.")
+        self.failures = Counter("jdvideo_failures_total", "Failed download attempts by reason.", "reason")
+        self.log_events = Counter("jdvideo_log_events_total", "Log events ingested via /log and /log/batch.")
+        self.fanout = Counter("jdvideo_fanout_total", "Extra destinations filled without a transfer, by method.",
+                              "method")
+        self.duration = Histogram("jdvideo_item_duration_seconds", "Time from first start to completion per item.",
+                                  (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+        self.ttfb = Histogram("jdvideo_ttfb_seconds", "Time to first byte (response headers) per request.",
+                              (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+        self.gauges = {}
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.bytes, self.items, self.retries, self.failures, self.log_events, self.fanout,
+                       self.duration, self.ttfb):
+            lines.extend(metric.render())
+        for name, (help_text, read) in self.gauges.items():
+            lines.extend([f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {_fmt_value(read())}"])
+        return "\n".join(lines) + "\n"
+
+
+class _TaskGroup:
+    """调度器内一个批次在某个优先级下的任务：按提交顺序排队。"""
+
+    __slots__ = ("key", "priority", "tasks")
+
+    def __init__(self, key: str, priority: int):
+        self.key = key
+        self.priority = priority
+        self.tasks = deque()
+
+
+class DownloadScheduler:
+    """全局下载调度器：所有批次共享一组常驻工作线程。
+
+    - limit：全局并发上限（--concurrency），多个批次同时提交也不会超出；
+    - per_host：单主机并发上限（--per-host，0 表示不限）；
+    - 高优先级的任务先取；同一优先级内批次之间轮询取任务，大批次不会饿死后提交的小批次；
+      高优先级任务暂时不可执行（退避、主机上限）时，低优先级任务照常执行；
+    - 任务可带 not_before（重试退避），到期前不占用工作线程；
+    - 排队中的任务可按批次与 tag 撤销（cancel）；
+    - limiter 按主机限制请求速率，令牌不足的任务留在队列里等待；
+    - 给出 engine（AsyncEngine）时不开工作线程，由一个派发线程把任务返回的协程交给事件循环，
+      协程结束时归还额度，limit 只是在途协程数的上限。
+    """
+
+    def __init__(self, limit: int, per_host: int = 0, limiter: Optional[HostLimiter] = None,
+                 engine: Optional[AsyncEngine] = None):
+        self.limit = max(1, limit)
+        self.per_host = per_host
+        self.limiter = limiter
+        self.engine = engine
+        self.active = 0
+        self.host_active = defaultdict(int)
+        # 优先级 -> 该优先级下轮询的批次队列
+        self._groups = {}
+        self._group_index = {}
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._workers = []
+        self._spawn(self.limit)
+
+    def _spawn(self, count: int):
+        if self.engine:
+            if not self._workers:
+                t = threading.Thread(target=self._dispatch, name="download-dispatch", daemon=True)
+                t.start()
+                self._workers.append(t)
+            return
+        # 工作线程只增不减；limit 调低时多出的线程在 _take 处等待
+        while len(self._workers) < count:
+            t = threading.Thread(target=self._work, name=f"download-{len(self._workers)}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def set_limit(self, limit: int):
+        with self._cond:
+            self.limit = max(1, limit)
+            self._spawn(self.limit)
+            self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"limit": self.limit, "active": self.active, "per_host": self.per_host,
+                    "host_active": dict(self.host_active), "workers": len(self._workers),
+                    "pending": self._pending()}
+
+    def submit(self, key: str, host: str, fn: Callable[[], None], delay: float = 0.0, priority: int = 0,
+               tag=None):
+        """提交一个任务到批次 key；同一批次同一优先级内按提交顺序执行，delay 秒之前不会被取出。
+        tag 用于之后按 cancel(key, tag) 撤销。"""
+        with self._cond:
+            group = self._group_index.get((key, priority))
+            if group is None:
+                group = self._group_index[(key, priority)] = _TaskGroup(key, priority)
+                self._groups.setdefault(priority, deque()).append(group)
+            group.tasks.append((host, fn, time.monotonic() + delay if delay > 0 else 0.0, tag))
+            self._cond.notify()
+
+    def cancel(self, key: str, tag=None) -> int:
+        """撤销批次 key 中尚未取出的任务（tag 为 None 时撤销全部），返回撤销的数量。"""
+        removed = 0
+        with self._cond:
+            for group in [g for g in self._group_index.values() if g.key == key]:
+                kept = deque(task for task in group.tasks if tag is not None and task[3] != tag)
+                removed += len(group.tasks) - len(kept)
+                group.tasks = kept
+                if not kept:
+                    self._drop_group(group)
+        return removed
+
+    def _drop_group(self, group: _TaskGroup):
+        # 调用方需持有 self._cond
+        groups = self._groups[group.priority]
+        groups.remove(group)
+        if not groups:
+            del self._groups[group.priority]
+        del self._group_index[(group.key, group.priority)]
+
+    def _pending(self) -> int:
+        return sum(len(g.tasks) for g in self._group_index.values())
+
+    def try_acquire(self, host: str, n: int) -> int:
+        """为已在执行的任务额外借用最多 n 个并发额度（分段下载用），不阻塞，返回实际借到的数量。"""
+        with self._cond:
+            grant = min(n, self.limit - self.active)
+            if self.per_host:
+                grant = min(grant, self.per_host - self.host_active[host])
+            grant = max(0, grant)
+            self.active += grant
+            self.host_active[host] += grant
+            return grant
+
+    def release(self, host: str, n: int):
+        if n <= 0:
+            return
+        with self._cond:
+            self.active -= n
+            self.host_active[host] -= n
+            if not self.host_active[host]:
+                del self.host_active[host]
+            self._cond.notify_all()
+
+    def pending(self) -> int:
+        with self._cond:
+            return self._pending()
+
+    def stop(self):
+        """停止派发新任务；已在执行的任务会继续完成。"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def _host_allowed(self, host: str) -> bool:
+        return not self.per_host or self.host_active[host] < self.per_host
+
+    def _take(self):
+        """取出下一个可执行任务；没有时返回 (None, 最早可重试的等待秒数或 None)。调用方需持有 self._cond。"""
+        if self.active >= self.limit:
+            return None, None
+        now = time.monotonic()
+        wake = None
+        for priority in sorted(self._groups, reverse=True):
+            task, retry_in = self._take_from(self._groups[priority], now)
+            if task is not None:
+                return task, None
+            if retry_in is not None:
+                wake = min(wake, retry_in) if wake is not None else retry_in
+        return None, wake
+
+    def _take_from(self, groups: deque, now: float):
+        """在同一优先级的批次间轮询取一个可执行任务，返回值同 _take。"""
+        wake = None
+        for _ in range(len(groups)):
+            group = groups[0]
+            groups.rotate(-1)
+            for i, (host, fn, not_before, _tag) in enumerate(group.tasks):
+                if not_before > now:
+                    wake = min(wake, not_before - now) if wake is not None else not_before - now
+                    continue
+                if not self._host_allowed(host):
+                    continue
+                if self.limiter:
+                    wait = self.limiter.request_wait(host)
+                    if wait > 0:
+                        wake = min(wake, wait) if wake is not None else wait
+                        continue
+                del group.tasks[i]
+                if not group.tasks:
+                    self._drop_group(group)
+                self.active += 1
+                self.host_active[host] += 1
+                return (host, fn), None
+        return None, wake
+
+    def _next(self):
+        """阻塞直到取出一个任务；调度器停止后返回 None。"""
+        with self._cond:
+            task, wake = self._take()
+            while task is None:
+                if self._stopped:
+                    return None
+                self._cond.wait(wake)
+                task, wake = self._take()
+            return task
+
+    def _dispatch(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            host, fn = task
+            try:
+                self.engine.start(fn(), lambda host=host: self.release(host, 1))
+            except Exception:
+                self.release(host, 1)
+
+    def _work(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            host, fn = task
+            try:
+                fn()
+            except Exception:
+                pass
+            finally:
+                self.release(host, 1)
+
+
+class AdaptiveController:
+    """AIMD 自适应并发控制（--adaptive）。
+
+    - 出现 403/429/5xx/超时：立即把 limit 减半（不低于 min_limit），随后一个周期内不再加；
+    - 每 interval 秒评估一次：并发已用满、聚合吞吐比上一周期提升至少 5%，
+      且 TTFB 中位数不超过基线的 1.5 倍时 limit +1（不超过 max_limit）；
+    - 最近的决策保存在 decisions 中，通过 GET /stats 查看。
+    """
+
+    BACKOFF_REASONS = ("http_403", "http_429", "http_5xx", "timeout")
+
+    def __init__(self, scheduler: DownloadScheduler, min_limit: int = 1, max_limit: int = 16,
+                 interval: float = 5.0):
+        self.scheduler = scheduler
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.interval = interval
+        self.decisions = deque(maxlen=50)
+        self._lock = threading.Lock()
+        # 每个数据块都会记一次，按线程分片累加，不加锁也不丢更新；评估时取两次汇总之差
+        self._bytes = Counter("jdvideo_adaptive_bytes", "Bytes seen by the adaptive controller.")
+        self._bytes_seen = 0.0
+        self._ttfb = []
+        self._errors = defaultdict(int)
+        self._busy = False
+        self._last_backoff = 0.0
+        self._last_rate = 0.0
+        self._baseline_ttfb = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="adaptive", daemon=True)
+        self._thread.start()
+
+    def record_bytes(self, n: int):
+        self._bytes.inc(n)
+
+    def monitor(self, kind: str, data: dict):
+        if kind == "response":
+            with self._lock:
+                self._ttfb.append(data["ttfb"])
+        elif kind == "error" and data["reason"] in self.BACKOFF_REASONS:
+            with self._lock:
+                self._errors[data["reason"]] += 1
+                now = time.monotonic()
+                if now - self._last_backoff < self.interval / 2:
+                    return
+                self._last_backoff = now
+                limit = max(self.min_limit, self.scheduler.limit // 2)
+                self._decide(limit, f"backoff on {data['reason']}")
+
+    def _decide(self, limit: int, reason: str):
+        # 调用方需持有 self._lock
+        previous = self.scheduler.limit
+        if limit != previous:
+            self.scheduler.set_limit(limit)
+        self.decisions.append({"ts": time.time(), "from": previous, "to": limit, "reason": reason})
+
+    def _run(self):
+        last = time.monotonic()
+        while not self._stopped.wait(self.interval / 5):
+            # 高频采样并发是否被用满，低频做加法决策
+            stats = self.scheduler.stats()
+            if stats["active"] >= stats["limit"] and stats["pending"]:
+                self._busy = True
+            now = time.monotonic()
+            if now - last >= self.interval:
+                self._evaluate(now - last)
+                last = now
+
+    def _evaluate(self, elapsed: float):
+        with self._lock:
+            total = self._bytes.value()
+            rate = (total - self._bytes_seen) / elapsed
+            self._bytes_seen = total
+            samples, self._ttfb = sorted(self._ttfb), []
+            busy, self._busy = self._busy, False
+            ttfb = samples[len(samples) // 2] if samples else None
+            if ttfb is not None and (self._baseline_ttfb is None or ttfb < self._baseline_ttfb):
+                self._baseline_ttfb = ttfb
+            previous_rate, self._last_rate = self._last_rate, rate
+            limit = self.scheduler.limit
+            if time.monotonic() - self._last_backoff < self.interval or not busy or limit >= self.max_limit:
+                return
+            latency_flat = ttfb is None or ttfb <= self._baseline_ttfb * 1.5
+            if rate >= previous_rate * 1.05 and latency_flat:
+                self._decide(limit + 1, f"throughput {previous_rate / 1e6:.2f}->{rate / 1e6:.2f} MB/s")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"limit": self.scheduler.limit, "min": self.min_limit, "max": self.max_limit,
+                    "interval": self.interval, "throughput": round(self._last_rate),
+                    "baseline_ttfb": self._baseline_ttfb, "errors": dict(self._errors),
+                    "decisions": list(self.decisions)}
+
+    def stop(self):
+        self._stopped.set()
+
+
+class DiskBudget:
+    """按文件系统的磁盘空间准入与写入限速。
+
+    条目拿到响应、得知总大小后、写入之前调用 admit：在条目所在的文件系统上预留「总大小 - 已有字节」，
+    直到条目成功、失败或取消（重试等待期间保留）。剩余空间减去其他条目尚未写入的预留与 min_free
+    后放不下时抛出 DISK_FULL 异常，由 JobQueue 按 policy 暂缓（hold，稍后重试，不计重试次数，
+    累计超过 max_hold 秒后失败）或直接失败（reject）。超过文件系统总容量减 min_free 的条目总是直接失败。
+    多目标批次中位于其他文件系统的副本按完整大小预留。policy 为 off 时不做准入。
+    write_bps 为每个文件系统的写入速率上限（0 不限）。
+    """
+
+    hold_seconds = 30.0
+
+    def __init__(self, min_free: int = 0, policy: str = "hold", write_bps: float = 0.0, copies_full: bool = False,
+                 max_hold: float = 3600.0):
+        self.min_free = min_free
+        self.policy = policy
+        self.max_hold = max_hold
+        self.write_bps = write_bps
+        # fan-out 为 copy 时同一文件系统上的副本也占用完整空间
+        self.copies_full = copies_full
+        self._lock = threading.Lock()
+        # 条目 key -> [(设备号, 条目, 是否按完整大小预留)]
+        self._claims = {}
+        self._devices = {}
+        self._buckets = {}
+
+    @staticmethod
+    def locate(path: str) -> tuple:
+        """返回 (设备号, 最近的已存在目录)；目标目录可能尚未创建。"""
+        directory = os.path.dirname(os.path.abspath(path))
+        while not os.path.exists(directory):
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                break
+            directory = parent
+        return os.stat(directory).st_dev, directory
+
+    def free_space(self, target_dir: str) -> int:
+        """target_dir 所在文件系统扣除 min_free 后的剩余空间（未计入在途预留）。"""
+        _, where = self.locate(os.path.join(target_dir, "x"))
+        return shutil.disk_usage(where).free - self.min_free
+
+    def _outstanding(self, dev: int, skip) -> int:
+        pending = 0
+        for key, claims in self._claims.items():
+            if key == skip:
+                continue
+            for claim_dev, it, full in claims:
+                if claim_dev == dev:
+                    size = it["total"] or 0
+                    pending += size if full else max(0, size - it["bytes"])
+        return pending
+
+    def admit(self, key, it: dict, total: Optional[int], done: int = 0):
+        dev, where = self.locate(it["path"])
+        self._devices[key] = dev
+        if not total or self.policy == "off":
+            return
+        claims = [(dev, it, False, where, total - done)]
+        for copy in it.get("copies") or ():
+            copy_dev, copy_where = self.locate(copy["path"])
+            if copy_dev != dev or self.copies_full:
+                claims.append((copy_dev, it, True, copy_where, total))
+        # 同一文件系统上的主文件与副本合并计算
+        needs = {}
+        for claim_dev, _, _, claim_where, need in claims:
+            needs[claim_dev] = (needs.get(claim_dev, (0, claim_where))[0] + need, claim_where)
+        with self._lock:
+            for claim_dev, (need, claim_where) in needs.items():
+                if need <= 0:
+                    continue
+                usage = shutil.disk_usage(claim_where)
+                if need > usage.total - self.min_free:
+                    raise Exception(f"{DISK_TOO_SMALL}: need {need} bytes, {usage.total - self.min_free} usable on {claim_where}")
+                available = usage.free - self._outstanding(claim_dev, key) - self.min_free
+                if need > available:
+                    raise Exception(f"{DISK_FULL}: need {need} bytes, {max(0, available)} available on {claim_where}")
+            self._claims[key] = [claim[:3] for claim in claims]
+
+    def release(self, key):
+        with self._lock:
+            self._claims.pop(key, None)
+        self._devices.pop(key, None)
+
+    def write_wait(self, key, n: int) -> float:
+        """记入 n 个写入字节，返回为不超出所在文件系统写入速率应等待的秒数。"""
+        if not self.write_bps:
+            return 0.0
+        dev = self._devices.get(key)
+        bucket = self._buckets.get(dev)
+        if bucket is None:
+            with self._lock:
+                bucket = self._buckets.setdefault(dev, TokenBucket(self.write_bps, self.write_bps))
+        return bucket.take(n)
+
+
+class JobQueue:
+    """服务端全局任务队列：提交即返回，条目交给全局调度器执行。"""
+
+    def __init__(self, concurrency: int, retry: int, log: LogWriter, per_host: int = 0,
+                 pool_size: int = 10, segments: int = 1, segment_threshold: int = 32 * 1024 * 1024,
+                 dedupe_file: Optional[str] = None, progress_interval: float = 0.5,
+                 adaptive: bool = False, max_concurrency: int = 16, limiter: Optional[HostLimiter] = None,
+                 retry_base: float = 1.0, retry_cap: float = 60.0, metrics: Optional[Metrics] = None,
+                 copy_buffer: int = COPY_BUFFER, preallocate: bool = False, verify: str = "off",
+                 journal_file: Optional[str] = None, engine: str = "thread", fanout: str = "link",
+                 disk: Optional[DiskBudget] = None, keep: int = 200):
+        self.retry = retry
+        self.disk = disk
+        # 多目标批次放置额外副本时优先尝试的方式（见 place_copy）
+        self.fanout = fanout
+        # engine="async" 时传输在事件循环上执行，分段下载不可用（总是单连接）
+        self.engine = AsyncEngine() if engine == "async" else None
+        self.journal = JobJournal(journal_file) if journal_file else None
+        # async 引擎下状态变化发生在事件循环线程上：日志写入交给单独一个线程按序提交，
+        # 不让 SQLite 提交和与 /download 处理线程争锁卡住所有在途协程
+        self._journal_writer = ThreadPoolExecutor(1, thread_name_prefix="journal") if self.engine and self.journal else None
+        # 已请求取消、尚未收尾的条目 (job_id, index)，以及在途响应的中断回调
+        self._cancelled = set()
+        self._inflight = {}
+        self.verify = verify
+        self.manifest = VerifyManifest() if verify != "off" else None
+        self.copy_buffer = copy_buffer
+        self.preallocate = preallocate
+        self.metrics = metrics or Metrics()
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.limiter = limiter
+        self.progress_interval = progress_interval
+        self.events = EventBus()
+        self.segments = segments
+        self.segment_threshold = segment_threshold
+        self.log = log
+        self.keep = keep
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.scheduler = DownloadScheduler(concurrency, per_host, limiter, self.engine)
+        self.controller = AdaptiveController(self.scheduler, 1, max_concurrency) if adaptive else None
+        self.metrics.gauges["jdvideo_queue_depth"] = ("Items waiting in the scheduler.", self.scheduler.pending)
+        self.metrics.gauges["jdvideo_active_workers"] = ("Transfers currently holding a slot.",
+                                                         lambda: self.scheduler.active)
+        self.metrics.gauges["jdvideo_concurrency_limit"] = ("Current global concurrency limit.",
+                                                            lambda: self.scheduler.limit)
+        # pool_size 为 0 时关闭连接复用（每次请求新建连接）
+        self.sessions = SessionPool(pool_size) if pool_size > 0 else None
+        self.dedupe = DedupeIndex(dedupe_file) if dedupe_file else None
+
+    def submit(self, items: list, target_dir: str, sub_dir: str, segments: int = 0, priority: int = 0,
+               destinations: Optional[list] = None) -> Job:
+        job = Job(items, target_dir, sub_dir, segments, priority, destinations)
+        if self.journal:
+            self.journal.add_job(job, segments)
+        self._start(job)
+        return job
+
+    def restore(self) -> int:
+        """从批次日志恢复上次进程退出时未完成的批次，返回重新入队的条目数。
+
+        已成功或失败的条目保持原状，其余条目（含中断时正在下载的）重新入队，
+        单连接下载会从 .part 残片续传。
+        """
+        if not self.journal:
+            return 0
+        restored = 0
+        for saved, items, states in self.journal.unfinished():
+            job = Job(items, saved["target"], saved["sub"], saved["segments"], saved["priority"], saved["destinations"])
+            job.id, job.created = saved["id"], saved["created"]
+            for it in job.items:
+                state = states.get(it["index"])
+                if state and it["url"]:
+                    it["state"] = state["state"] if state["state"] in ("ok", "fail", "cancelled") else "queued"
+                    it["attempts"], it["error"] = state["attempts"], state["error"]
+            pending = self._start(job)
+            restored += pending
+            self.log.write({"event": "server:job_restored", "job": job.id, "pending": pending, "total": len(job.items)})
+        return restored
+
+    def _start(self, job: Job) -> int:
+        pending = [it for it in job.items if it["state"] == "queued"]
+        job.remaining = len(pending)
+        with self._lock:
+            self.jobs[job.id] = job
+            self._prune()
+        self.events.publish({"type": "job", **job.snapshot(with_items=False)})
+        if not pending:
+            self._finish(job)
+        for it in pending:
+            self._schedule(job, it)
+        return len(pending)
+
+    def _schedule(self, job: Job, it: dict, delay: float = 0.0):
+        host = urlparse(it["url"]).netloc
+        run = self._run_item_async if self.engine else self._run_item
+        self.scheduler.submit(job.id, host, lambda: run(job, it), delay, it["priority"], it["index"])
+
+    def cancel(self, job: Job, index: Optional[int] = None) -> int:
+        """取消批次中排队或进行中的条目（index 为 None 时取消整批），返回被取消的条目数。
+
+        排队中的条目直接从调度器撤下；进行中的条目中断其在途请求，由工作线程收尾。
+        被取消条目的 .part 残片都会删除。
+        """
+        with self._lock:
+            targets = [it for it in job.items
+                       if it["url"] and it["state"] in ("queued", "running") and (index is None or it["index"] == index)
+                       and (job.id, it["index"]) not in self._cancelled]
+            self._cancelled.update((job.id, it["index"]) for it in targets)
+            # 撤下成功说明没有工作线程持有该条目，由这里收尾
+            dequeued = [it for it in targets if self.scheduler.cancel(job.id, it["index"])]
+            aborts = [abort for it in targets for abort in self._inflight.get((job.id, it["index"]), ())]
+        for abort in aborts:
+            abort()
+        for it in dequeued:
+            self._settle_cancelled(job, it)
+        return len(targets)
+
+    def _settle_cancelled(self, job: Job, it: dict):
+        it["error"] = "cancelled"
+        _drop_part(it["path"] + ".part", it["path"] + ".part.json")
+        self.metrics.items.inc(1, "cancelled")
+        self._set_state(job, it, "cancelled")
+        self.log.write({"event": "cancel", "job": job.id, "sku": it["sku"]})
+        self._item_done(job, it)
+
+    def _item_done(self, job: Job, it: dict):
+        if self.disk:
+            self.disk.release((job.id, it["index"]))
+        with self._lock:
+            self._cancelled.discard((job.id, it["index"]))
+            self._inflight.pop((job.id, it["index"]), None)
+            job.remaining -= 1
+            done = job.remaining == 0
+        if done:
+            self._finish(job)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def list(self) -> list:
+        with self._lock:
+            return list(self.jobs.values())
+
+    def close(self):
+        self.scheduler.stop()
+        self.events.close()
+        if self.controller:
+            self.controller.stop()
+        if self.sessions:
+            self.sessions.close()
+        if self.engine:
+            self.engine.close()
+        if self._journal_writer:
+            self._journal_writer.shutdown(wait=True)
+        if self.journal:
+            self.journal.close()
+
+    def _journal_write(self, fn: Callable, *args):
+        if self._journal_writer:
+            self._journal_writer.submit(fn, *args)
+        else:
+            fn(*args)
+
+    def _prune(self):
+        # 只保留最近 keep 个已完成批次，未完成的永不淘汰
+        done = [jid for jid, job in self.jobs.items() if job.finished]
+        for jid in done[: max(0, len(done) - self.keep)]:
+            del self.jobs[jid]
+
+    def _finish(self, job: Job):
+        job.finished = time.time()
+        if self.journal:
+            self._journal_write(self.journal.finish, job.id)
+        self.events.publish({"type": "job", **job.snapshot(with_items=False)})
+        self.log.write({"event": "server:job_done", "job": job.id, "success": job.snapshot(False)["success"], "total": len(job.items)})
+
+    def _fetch(self, it: dict, progress: Callable[..., None], monitor: Callable[[str, dict], None]):
+        session = self.sessions.get(it["url"]) if self.sessions else None
+        skipped = self._precheck(it, progress, session)
+        if skipped:
+            return skipped
+        info = {} if self.dedupe or self.manifest else None
+        ok, err = self._transfer(it, progress, session, info, monitor)
+        if not ok:
+            return ok, err
+        return self._postcheck(it, info, monitor)
+
+    async def _fetch_async(self, it: dict, progress: Callable[..., Optional[float]],
+                           monitor: Callable[[str, dict], None]):
+        """_fetch 的事件循环版本：清单/去重检查与下载后校验在线程池中执行，传输走 download_file_async。"""
+        if (self.manifest or self.dedupe) and not it["attempts"]:
+            session = self.sessions.get(it["url"]) if self.sessions else None
+            skipped = await self.engine.offload(self._precheck, it, progress, session)
+            if skipped:
+                return skipped
+        info = {} if self.dedupe or self.manifest else None
+        ok, err = await download_file_async(self.engine, it["url"], it["path"], it["headers"], progress, info,
+                                            monitor, self.copy_buffer, self.preallocate)
+        if not ok or info is None:
+            return ok, err
+        return await self.engine.offload(self._postcheck, it, info, monitor)
+
+    def _precheck(self, it: dict, progress: Callable[..., None], session: Optional[requests.Session]):
+        """首次尝试前查清单与去重索引：命中时返回 (True, None)，否则返回 None 表示需要下载。"""
+        if self.manifest and not it["attempts"]:
+            entry = self.manifest.lookup(it["path"], it["url"])
+            if entry:
+                # 之前已校验通过且文件未被改动：不发任何请求
+                it["verified"] = "manifest"
+                progress(-1, entry["size"], entry["size"])
+                return True, None
+        if self.dedupe and not it["attempts"]:
+            entry, matched_by = self.dedupe.lookup(it["url"], it["sku"])
+            if entry and verify_unchanged(it["url"], entry, matched_by, it["headers"], session):
+                # 内容未变：同一路径直接跳过，其他路径硬链接过去，不再走网络传输
+                if entry["path"] == it["path"]:
+                    it["dedupe"] = "skip"
+                else:
+                    it["dedupe"] = place_copy(entry["path"], it["path"])
+                self.dedupe.record(it["path"], it["url"], it["sku"], entry)
+                progress(-1, entry["size"], entry["size"])
+                return True, None
+        return None
+
+    def _postcheck(self, it: dict, info: Optional[dict], monitor: Callable[[str, dict], None]):
+        """传输成功后的校验、去重登记与清单记录，返回最终的 (ok, err)。"""
+        if self.manifest:
+            reason = verify_download(it["path"], info, self.verify)
+            if reason:
+                # 校验失败的文件直接删除，由重试重新完整下载
+                try:
+                    os.remove(it["path"])
+                except OSError:
+                    pass
+                monitor("error", {"reason": "verify", "retry_after": None})
+                return False, f"verify failed: {reason}"
+            it["verified"] = self.verify
+        if self.dedupe:
+            same = self.dedupe.lookup_hash(info["sha256"])
+            if same and same["path"] != it["path"]:
+                # 不同签名 URL 下载到了相同内容：改为指向已有文件的硬链接，只保留一份数据
+                it["dedupe"] = place_copy(same["path"], it["path"], allow_copy=False)
+            self.dedupe.record(it["path"], it["url"], it["sku"], info)
+        if self.manifest:
+            self.manifest.record(it["path"], it["url"], info, self.verify)
+        return True, None
+
+    def _place_copies(self, it: dict):
+        """把下载完成的文件放到条目的其余目标位置，不再走网络；任何一处失败都按失败重试（只重试放置）。"""
+        for copy in it["copies"]:
+            try:
+                copy["method"] = place_copy(it["path"], copy["path"], prefer=self.fanout)
+            except OSError as e:
+                return False, f"fan-out failed: {copy['path']}: {e}"
+            self.metrics.fanout.inc(1, copy["method"])
+        return True, None
+
+    def _transfer(self, it: dict, progress: Callable[..., None], session: Optional[requests.Session],
+                  info: Optional[dict], monitor: Callable[[str, dict], None]):
+        """执行一次传输尝试；单连接下载的重试由 _run_item 重新入队完成，不在工作线程里等待。"""
+        segments = it["segments"] or self.segments
+        if segments > 1:
+            probe = {"total": None}
+            try:
+                probe = probe_range(it["url"], it["headers"], session)
+            except Exception:
+                pass
+            if probe["total"] and probe["total"] >= self.segment_threshold:
+                # 额外分段占用全局并发额度；借不到时退化为单连接下载
+                host = urlparse(it["url"]).netloc
+                extra = self.scheduler.try_acquire(host, segments - 1)
+                try:
+                    if extra:
+                        return download_segmented(it["url"], it["path"], probe, extra + 1, self.retry,
+                                                  it["headers"], progress, session, info, monitor, self.copy_buffer)
+                finally:
+                    self.scheduler.release(host, extra)
+        return download_file(it["url"], it["path"], 0, it["headers"], progress, session, info, monitor,
+                             self.copy_buffer, self.preallocate)
+
+    def _monitor(self, kind: str, data: dict):
+        if kind == "response":
+            self.metrics.ttfb.observe(data["ttfb"])
+        elif kind == "error":
+            self.metrics.failures.inc(1, data["reason"])
+        if self.controller:
+            self.controller.monitor(kind, data)
+
+    def stats(self) -> dict:
+        return {"scheduler": self.scheduler.stats(),
+                "adaptive": self.controller.snapshot() if self.controller else None}
+
+    def _set_state(self, job: Job, it: dict, state: str):
+        it["state"] = state
+        if self.journal:
+            # 交给日志线程时条目还会继续变化，传当时的副本
+            self._journal_write(self.journal.transition, job.id, dict(it) if self._journal_writer else it)
+        self.events.publish({"type": "state", "job": job.id, "index": it["index"], "sku": it["sku"],
+                             "state": state, "bytes": it["bytes"], "total": it["total"],
+                             "path": it["path"], "error": it["error"], "dedupe": it["dedupe"]})
+
+    def _run_item(self, job: Job, it: dict):
+        hooks = self._begin_item(job, it)
+        if hooks is None:
+            return
+        try:
+            if self._refetch_needed(it):
+                ok, err = self._fetch(it, hooks[0], hooks[1])
+                it["fetched"] = ok
+            else:
+                ok, err = True, None
+            if ok and it["copies"]:
+                ok, err = self._place_copies(it)
+        except Exception as e:
+            ok, err = False, str(e)
+        self._end_item(job, it, ok, err, hooks[2])
+
+    async def _run_item_async(self, job: Job, it: dict):
+        hooks = self._begin_item(job, it)
+        if hooks is None:
+            return
+        try:
+            if self._refetch_needed(it):
+                ok, err = await self._fetch_async(it, hooks[0], hooks[1])
+                it["fetched"] = ok
+            else:
+                ok, err = True, None
+            if ok and it["copies"]:
+                ok, err = await self.engine.offload(self._place_copies, it)
+        except Exception as e:
+            ok, err = False, str(e)
+        self._end_item(job, it, ok, err, hooks[2])
+
+    @staticmethod
+    def _refetch_needed(it: dict) -> bool:
+        # 主文件已下好、只是放置副本失败时，重试只重做放置，不再走网络
+        return not (it["fetched"] and os.path.exists(it["path"]))
+
+    def _begin_item(self, job: Job, it: dict):
+        """条目开始执行：已取消则收尾并返回 None，否则返回 (progress, monitor, last_error)。"""
+        key = (job.id, it["index"])
+        if key in self._cancelled:
+            self._settle_cancelled(job, it)
+            return None
+        self._set_state(job, it, "running")
+        host = urlparse(it["url"]).netloc
+        started = time.monotonic()
+        if it["started"] is None:
+            it["started"] = started
+        bytes_counter = self.metrics.bytes
+        last_publish = [0.0]
+        last_error = {}
+
+        def progress(n: int, total: Optional[int] = None, done: int = 0):
+            # done 为续传或去重时已有的字节数，只计入条目进度，不计入下载字节数与限速
+            if key in self._cancelled:
+                raise Exception("cancelled")
+            wait = 0.0
+            if n < 0:
+                if self.disk:
+                    # 写入前的磁盘空间准入；放不下时本次尝试以 DISK_FULL 失败
+                    self.disk.admit(key, it, total, done)
+                it["bytes"] = done
+                it["total"] = total
+            else:
+                it["bytes"] += n
+                bytes_counter.inc(n)
+                if self.controller:
+                    self.controller.record_bytes(n)
+                if self.limiter:
+                    wait = self.limiter.bytes_wait(host, n)
+                if self.disk:
+                    wait = max(wait, self.disk.write_wait(key, n))
+            # 按 progress_interval 节流，没有订阅者时不构造事件
+            now = time.monotonic()
+            if now - last_publish[0] >= self.progress_interval and self.events.active():
+                last_publish[0] = now
+                elapsed = now - started
+                self.events.publish({"type": "progress", "job": job.id, "index": it["index"], "sku": it["sku"],
+                                     "bytes": it["bytes"], "total": it["total"],
+                                     "rate": round(it["bytes"] / elapsed) if elapsed > 0 else 0})
+            # 限速等待交给下载函数：线程里 sleep（分段下载在释放进度锁之后），事件循环上 await
+            return wait
+
+        def monitor(kind: str, data: dict):
+            if kind == "response" and "abort" in data:
+                with self._lock:
+                    self._inflight.setdefault(key, []).append(data["abort"])
+                    cancelled = key in self._cancelled
+                if cancelled:
+                    # 取消请求先于响应到达：注册后立即中断
+                    data["abort"]()
+            if key in self._cancelled:
+                # 被取消导致的失败不计入错误统计，也不影响自适应并发
+                return
+            if kind == "error":
+                last_error.update(data)
+            self._monitor(kind, data)
+
+        return progress, monitor, last_error
+
+    def _end_item(self, job: Job, it: dict, ok: bool, err: Optional[str], last_error: dict):
+        """按一次尝试的结果收尾：成功、失败，或退避后重新入队。"""
+        key = (job.id, it["index"])
+        with self._lock:
+            self._inflight.pop(key, None)
+        if not ok and key in self._cancelled:
+            return self._settle_cancelled(job, it)
+        disk_full = not ok and self.disk is not None and (err or "").startswith(DISK_FULL)
+        if disk_full and self.disk.policy == "hold" and not err.startswith(DISK_TOO_SMALL) \
+                and it["held"] < self.disk.max_hold:
+            # 空间不足：稍后再试，不计入重试次数；累计暂缓时间有上限，磁盘一直不腾空间时最终失败
+            it["held"] += self.disk.hold_seconds
+            it["error"] = err
+            self._set_state(job, it, "queued")
+            self.log.write({"event": "disk_hold", "job": job.id, "sku": it["sku"], "error": err})
+            self._schedule(job, it, self.disk.hold_seconds)
+            return
+        final = ok or it["attempts"] >= self.retry or disk_full
+        if final:
+            self.metrics.items.inc(1, "ok" if ok else "fail")
+            self.metrics.duration.observe(time.monotonic() - it["started"])
+        if ok:
+            it["error"] = None
+            self._set_state(job, it, "ok")
+            self.log.write({"event": "ok", "job": job.id, "sku": it["sku"], "path": it["path"]})
+        elif not final:
+            # 退避后重新入队：等待期间不占用工作线程与并发额度
+            delay = backoff_delay(it["attempts"], self.retry_base, self.retry_cap, last_error.get("retry_after"))
+            it["attempts"] += 1
+            it["error"] = err
+            self.metrics.retries.inc()
+            self._set_state(job, it, "queued")
+            self.log.write({"event": "retry", "job": job.id, "sku": it["sku"], "attempt": it["attempts"],
+                            "delay": round(delay, 2), "error": err})
+            self._schedule(job, it, delay)
+            return
+        else:
+            it["error"] = err
+            self._set_state(job, it, "fail")
+            self.log.write({"event": "fail", "job": job.id, "sku": it["sku"], "error": err, "url": it["url"]})
+        self._item_done(job, it)
+
+
+class _BodyReader(io.RawIOBase):
+    """把请求体限制在 Content-Length 之内的只读流。"""
+
+    def __init__(self, rfile, length: int):
+        self._rfile = rfile
+        self._remaining = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if self._remaining <= 0:
+            return 0
+        view = memoryview(buffer)[: self._remaining]
+        n = self._rfile.readinto(view)
+        self._remaining -= n or 0
+        return n or 0
 
 
 class Handler(BaseHTTPRequestHandler):
@@ -174,13 +2907,122 @@ class Handler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(body)
 
+    def _stream_events(self, job_id: Optional[str]):
+        """Server-Sent Events：推送批次/条目状态变化与节流后的字节进度；空闲时每 15 秒发送注释行保活。"""
+        events = self.server.jobs.events
+        q = events.subscribe(job_id)
+        try:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.close_connection = True
+            self.wfile.write(b": connected\n\n")
+            self.wfile.flush()
+            while True:
+                try:
+                    event = q.get(timeout=15)
+                except queue.Empty:
+                    self.wfile.write(b": ping\n\n")
+                    self.wfile.flush()
+                    continue
+                if event is None:
+                    return
+                data = json.dumps(event, ensure_ascii=False)
+                self.wfile.write(f"event: {event['type']}\ndata: {data}\n\n".encode("utf-8"))
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return
+        finally:
+            events.unsubscribe(q)
+
+    def _query_logs(self, query: dict):
+        index = self.server.log.index
+        if not index:
+            return self._send_json(404, {"ok": False, "error": "log_index_disabled"})
+
+        def arg(name):
+            values = query.get(name)
+            return values[0] if values and values[0] != "" else None
+
+        try:
+            since = float(arg("since")) if arg("since") else None
+            until = float(arg("until")) if arg("until") else None
+            cursor = int(arg("cursor") or 0)
+            limit = max(1, min(1000, int(arg("limit") or 100)))
+        except ValueError:
+            return self._send_json(400, {"ok": False, "error": "invalid_query"})
+        self.server.log.flush(timeout=2)
+        items, next_cursor = index.query(arg("event"), arg("sku"), since, until, cursor, limit)
+        data = {"ok": True, "items": items, "next_cursor": next_cursor}
+        if self.server.log.history_truncated():
+            # 更早的日志段不在索引里：告诉调用方结果从哪个时间点开始
+            data["truncated_before"] = index.first_ts()
+        return self._send_json(200, data)
+
     def do_GET(self):
+        parsed = urlparse(self.path)
+        path = parsed.path.rstrip("/")
+        if path == "/logs":
+            return self._query_logs(parse_qs(parsed.query))
+        if path == "/events":
+            return self._stream_events((parse_qs(parsed.query).get("job") or [None])[0])
+        if path == "/metrics":
+            body = self.server.metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path == "/stats":
+            return self._send_json(200, {"ok": True, **self.server.jobs.stats()})
+        if path == "/jobs":
+            jobs = [job.snapshot(with_items=False) for job in self.server.jobs.list()]
+            return self._send_json(200, {"ok": True, "jobs": jobs})
+        if path.startswith("/jobs/"):
+            job = self.server.jobs.get(path[len("/jobs/"):])
+            if not job:
+                return self._send_json(404, {"ok": False, "error": "job_not_found"})
+            return self._send_json(200, {"ok": True, "job": job.snapshot()})
         # 健康检查或默认访问
         self._send_json(200, {"ok": True, "msg": "use POST /download"})
 
+    def _ingest_ndjson(self, length: int) -> dict:
+        """逐行读取 NDJSON 请求体写入日志，不把整个请求体读进内存；支持 Content-Encoding: gzip。"""
+        stream = io.BufferedReader(_BodyReader(self.rfile, length), 64 * 1024)
+        if self.headers.get("Content-Encoding", "").lower() == "gzip":
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+        accepted = rejected = 0
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                rejected += 1
+                continue
+            if not isinstance(entry, dict):
+                rejected += 1
+                continue
+            self.server.log.write(entry)
+            accepted += 1
+        return {"accepted": accepted, "rejected": rejected}
+
     def do_POST(self):
         parsed = urlparse(self.path)
         length = int(self.headers.get("Content-Length", "0"))
+        if parsed.path == "/log/batch":
+            try:
+                counts = self._ingest_ndjson(length)
+            except (OSError, EOFError, zlib.error) as e:
+                self.close_connection = True
+                return self._send_json(400, {"ok": False, "error": f"invalid_body: {e}"})
+            self.server.metrics.log_events.inc(counts["accepted"])
+            return self._send_json(200, {"ok": True, **counts})
+
         raw = self.rfile.read(length)
         try:
             payload = json.loads(raw.decode("utf-8"))
@@ -188,7 +3030,8 @@ class Handler(BaseHTTPRequestHandler):
             return self._send_json(400, {"ok": False, "error": "invalid_json"})
 
         if parsed.path == "/log":
-            append_log(self.server.log_file, payload)
+            self.server.log.write(payload)
+            self.server.metrics.log_events.inc()
             return self._send_json(200, {"ok": True})
 
         if parsed.path != "/download":
@@ -198,55 +3041,136 @@ class Handler(BaseHTTPRequestHandler):
         target_dir = payload.get("target_dir") or self.server.root_dir
         sub_dir = payload.get("sub_dir") or ""
 
-        # 记录原始输入用于调试
-        import sys
-        print(f"[download] received target_dir raw: {repr(target_dir)}", file=sys.stderr)
+        logger.debug("[download] received target_dir raw: %r", target_dir)
         target_dir = normalize_root(target_dir, self.server.root_dir)
-        print(f"[download] normalized target_dir: {target_dir}", file=sys.stderr)
-
-        results = []
-        success = 0
-        append_log(self.server.log_file, {"event": "server:recv", "count": len(items), "target": target_dir, "sub": sub_dir})
+        logger.debug("[download] normalized target_dir: %s", target_dir)
 
-        with ThreadPoolExecutor(max_workers=self.server.concurrency) as pool:
-            futures = {}
+        try:
+            priority = parse_priority(payload.get("priority"))
             for item in items:
-                sku = item.get("sku") or "unknown"
-                title = item.get("title") or "video"
-                url = item.get("videoUrl")
-                if not url:
-                    results.append({"sku": sku, "title": title, "ok": False, "error": "missing_url"})
-                    continue
-                path = build_path(target_dir, sub_dir, sku, title)
-                headers = item.get("headers") or {}
-                fut = pool.submit(download_file, url, path, self.server.retry, headers)
-                futures[fut] = (sku, title, path, url)
-
-            for fut in as_completed(futures):
-                sku, title, path, url = futures[fut]
-                ok, err = fut.result()
-                if ok:
-                    success += 1
-                    results.append({"sku": sku, "title": title, "ok": True, "path": path})
-                    append_log(self.server.log_file, {"event": "ok", "sku": sku, "path": path})
-                else:
-                    results.append({"sku": sku, "title": title, "ok": False, "error": err, "url": url})
-                    append_log(self.server.log_file, {"event": "fail", "sku": sku, "error": err, "url": url})
+                parse_priority(item.get("priority"))
+        except (TypeError, ValueError):
+            return self._send_json(400, {"ok": False, "error": "invalid_priority"})
+        try:
+            segments = parse_segments(payload.get("segments"))
+            for item in items:
+                parse_segments(item.get("segments"))
+        except (TypeError, ValueError):
+            return self._send_json(400, {"ok": False, "error": "invalid_segments"})
+        try:
+            destinations = parse_destinations(payload.get("destinations"), sub_dir, self.server.root_dir)
+            for item in items:
+                if item.get("destinations") is not None:
+                    item["destinations"] = parse_destinations(item["destinations"], sub_dir, self.server.root_dir)
+        except (AttributeError, ValueError):
+            return self._send_json(400, {"ok": False, "error": "invalid_destinations"})
+        disk = self.server.jobs.disk
+        if disk and disk.policy == "reject" and items:
+            # 目标文件系统已低于保留空间：整批直接拒绝，不再逐个条目失败
+            targets = [target_dir] + [dest[0] for dest in destinations or ()]
+            if any(disk.free_space(target) < 0 for target in targets):
+                return self._send_json(507, {"ok": False, "error": "insufficient_storage"})
+        job = self.server.jobs.submit(items, target_dir, sub_dir, segments, priority,
+                                      destinations)
+        self.server.log.write({"event": "server:recv", "job": job.id, "count": len(items), "target": target_dir, "sub": sub_dir})
+        return self._send_json(202, {"ok": True, "job_id": job.id, "total": len(items)})
+
+
+    def do_DELETE(self):
+        # DELETE /jobs/<id> 取消整批；DELETE /jobs/<id>/items/<index> 取消单个条目
+        parts = urlparse(self.path).path.strip("/").split("/")
+        if len(parts) not in (2, 4) or parts[0] != "jobs" or (len(parts) == 4 and parts[2] != "items"):
+            return self._send_json(404, {"ok": False, "error": "not_found"})
+        job = self.server.jobs.get(parts[1])
+        if not job:
+            return self._send_json(404, {"ok": False, "error": "job_not_found"})
+        index = None
+        if len(parts) == 4:
+            try:
+                index = int(parts[3])
+            except ValueError:
+                return self._send_json(400, {"ok": False, "error": "invalid_index"})
+            if not 0 <= index < len(job.items):
+                return self._send_json(404, {"ok": False, "error": "item_not_found"})
+        cancelled = self.server.jobs.cancel(job, index)
+        self.server.log.write({"event": "server:cancel", "job": job.id, "index": index, "cancelled": cancelled})
+        return self._send_json(200, {"ok": True, "job_id": job.id, "cancelled": cancelled})
+
+
+class DownloaderServer(ThreadingHTTPServer):
+    """每个请求一个线程，/log 与状态查询不会被慢请求阻塞。"""
 
-        return self._send_json(200, {"ok": True, "success": success, "total": len(items), "results": results})
+    daemon_threads = True
+    # 扩展捕获期间会密集发送 /log，默认 backlog=5 容易溢出，触发约 1s 的 SYN 重传
+    request_queue_size = 128
 
+    def server_close(self):
+        super().server_close()
+        self.jobs.close()
+        self.log.close()
 
-def run_server(host: str, port: int, root_dir: str, concurrency: int, retry: int):
-    server = HTTPServer((host, port), Handler)
+
+def create_server(host: str, port: int, root_dir: str, concurrency: int, retry: int,
+                  per_host: int = 0, pool_size: int = 10, segments: int = 1,
+                  segment_threshold: int = 32 * 1024 * 1024, dedupe: bool = True,
+                  log_options: Optional[dict] = None, progress_interval: float = 0.5,
+                  adaptive: bool = False, max_concurrency: int = 16, host_rps: float = 0.0,
+                  host_bps: float = 0.0, retry_base: float = 1.0, retry_cap: float = 60.0,
+                  copy_buffer: int = COPY_BUFFER, preallocate: bool = False, verify: str = "off",
+                  journal: bool = True, engine: str = "thread", fanout: str = "link",
+                  min_free: int = 0, disk_bps: float = 0.0, disk_policy: str = "hold", disk_hold: float = 3600.0,
+                  server_cls: type = DownloaderServer) -> HTTPServer:
+    """log_options 透传给 LogWriter（flush_interval/batch_size/max_bytes/backups/compress）。"""
+    server = server_cls((host, port), Handler)
     server.root_dir = root_dir
     server.concurrency = concurrency
     server.retry = retry
     server.log_file = os.path.join(root_dir, "logs", "jdvideo.log")
-    print(f"[server] listening on http://{host}:{port}, root={root_dir}, concurrency={concurrency}, retry={retry}")
+    server.log = LogWriter(server.log_file, index=LogIndex(server.log_file), **(log_options or {}))
+    server.metrics = Metrics()
+    dedupe_file = os.path.join(root_dir, ".jdvideo", "dedupe.jsonl") if dedupe else None
+    server.jobs = JobQueue(
+        concurrency, retry, server.log, per_host=per_host, pool_size=pool_size, segments=segments,
+        segment_threshold=segment_threshold, dedupe_file=dedupe_file, progress_interval=progress_interval,
+        adaptive=adaptive, max_concurrency=max_concurrency,
+        limiter=HostLimiter(host_rps, host_bps) if host_rps or host_bps else None,
+        retry_base=retry_base, retry_cap=retry_cap, metrics=server.metrics, copy_buffer=copy_buffer,
+        preallocate=preallocate, verify=verify,
+        journal_file=os.path.join(root_dir, ".jdvideo", "journal.db") if journal else None,
+        engine=engine, fanout=fanout,
+        disk=DiskBudget(min_free, disk_policy, disk_bps, copies_full=fanout == "copy", max_hold=disk_hold)
+        if disk_policy != "off" or disk_bps else None)
+    # 上次进程退出时未完成的批次直接续跑，无需扩展重新提交
+    server.restored = server.jobs.restore()
+    return server
+
+
+def run_server(host: str, port: int, root_dir: str, concurrency: int, retry: int, per_host: int = 0,
+               pool_size: int = 10, segments: int = 1, segment_threshold: int = 32 * 1024 * 1024,
+               dedupe: bool = True, log_options: Optional[dict] = None, progress_interval: float = 0.5,
+               adaptive: bool = False, max_concurrency: int = 16, host_rps: float = 0.0, host_bps: float = 0.0,
+               retry_base: float = 1.0, retry_cap: float = 60.0, copy_buffer: int = COPY_BUFFER,
+               preallocate: bool = False, verify: str = "off", journal: bool = True, engine: str = "thread",
+               fanout: str = "link", min_free: int = 0, disk_bps: float = 0.0, disk_policy: str = "hold",
+               disk_hold: float = 3600.0):
+    server = create_server(
+        host, port, root_dir, concurrency, retry, per_host=per_host, pool_size=pool_size, segments=segments,
+        segment_threshold=segment_threshold, dedupe=dedupe, log_options=log_options,
+        progress_interval=progress_interval, adaptive=adaptive, max_concurrency=max_concurrency,
+        host_rps=host_rps, host_bps=host_bps, retry_base=retry_base, retry_cap=retry_cap, copy_buffer=copy_buffer,
+        preallocate=preallocate, verify=verify, journal=journal, engine=engine, fanout=fanout,
+        min_free=min_free, disk_bps=disk_bps, disk_policy=disk_policy, disk_hold=disk_hold)
+    print(f"[server] listening on http://{host}:{port}, root={root_dir}, concurrency={concurrency}, per_host={per_host}, retry={retry}, engine={engine}")
+    if server.restored:
+        print(f"[server] resumed {server.restored} unfinished item(s) from the job journal")
+    # SIGTERM 也走正常退出流程，保证日志队列落盘
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     try:
         server.serve_forever()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, SystemExit):
         print("bye")
+    finally:
+        server.server_close()
 
 
 if __name__ == "__main__":
@@ -255,10 +3179,60 @@ if __name__ == "__main__":
     parser.add_argument("--port", type=int, default=3030)
     parser.add_argument("--root", default="./downloads", help="默认保存根目录（可相对/绝对）")
     parser.add_argument("--concurrency", type=int, default=3)
+    parser.add_argument("--adaptive", action="store_true", help="根据吞吐与错误率自动调整并发（从 --concurrency 起步）")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="--adaptive 时的并发上限")
+    parser.add_argument("--per-host", type=int, default=0, help="单个主机的并发上限，0 表示只受 --concurrency 限制")
     parser.add_argument("--retry", type=int, default=2)
+    parser.add_argument("--retry-base", type=float, default=1.0, help="重试退避基数（秒），第 n 次重试最多等待 base*2^n")
+    parser.add_argument("--retry-cap", type=float, default=60.0, help="单次重试退避的上限（秒）")
+    parser.add_argument("--host-rps", type=float, default=0.0, help="单个主机每秒最多发起的请求数，0 表示不限")
+    parser.add_argument("--host-mbps", type=float, default=0.0, help="单个主机的下载带宽上限（MB/s），0 表示不限")
+    parser.add_argument("--pool-size", type=int, default=10, help="每个主机保持的 keep-alive 连接数，0 表示不复用连接")
+    parser.add_argument("--segments", type=int, default=1, help="大文件默认分段数，1 表示不分段（请求中的 segments 优先）")
+    parser.add_argument("--segment-threshold", type=int, default=32, help="启用分段下载的最小文件大小（MB）")
+    parser.add_argument("--no-dedupe", action="store_true", help="关闭去重索引，每次都完整下载")
+    parser.add_argument("--no-journal", action="store_true", help="关闭批次日志，重启后不恢复未完成的条目")
+    parser.add_argument("--engine", choices=("thread", "async"), default="thread",
+                        help="传输引擎：thread 每个下载占一个线程；async 在一个事件循环上并发全部下载（需 aiohttp，不支持分段）")
+    parser.add_argument("--fanout", choices=PLACE_METHODS, default="link",
+                        help="多目标批次放置额外副本的方式：link 硬链接优先，reflink 写时复制优先，copy 总是复制；"
+                             "做不到时依次回退")
+    parser.add_argument("--min-free-mb", type=int, default=0, help="每个目标文件系统至少保留的剩余空间（MB）")
+    parser.add_argument("--disk-policy", choices=("hold", "reject", "off"), default="hold",
+                        help="条目放不下时：hold 暂缓、稍后再试；reject 直接失败（已低于保留空间的批次返回 507）；off 不检查")
+    parser.add_argument("--disk-hold-minutes", type=float, default=60.0,
+                        help="hold 时单个条目累计暂缓的上限（分钟），超过后按失败处理")
+    parser.add_argument("--disk-mbps", type=float, default=0.0, help="每个文件系统的写入速率上限（MB/s），0 表示不限")
+    parser.add_argument("--copy-buffer", type=int, default=1024, help="下载读写缓冲大小（KB）")
+    parser.add_argument("--preallocate", action="store_true", help="已知大小的文件先用 posix_fallocate 预分配磁盘空间")
+    parser.add_argument("--verify", choices=("off", "size", "mp4"), default="off",
+                        help="下载后校验：size 核对大小，mp4 另检查容器结构（moov）；校验结果写入各目录的清单")
+    parser.add_argument("--log-flush-interval", type=float, default=0.5, help="日志批量落盘间隔（秒）")
+    parser.add_argument("--log-batch", type=int, default=500, help="攒够多少条日志立即落盘")
+    parser.add_argument("--log-max-mb", type=int, default=50, help="日志文件轮转大小（MB），0 表示不轮转")
+    parser.add_argument("--log-backups", type=int, default=5, help="保留的轮转日志份数")
+    parser.add_argument("--log-gzip", action="store_true", help="轮转后的旧日志用 gzip 压缩")
+    parser.add_argument("--log-level", choices=("debug", "info", "warning", "error"), default="warning",
+                        help="控制台诊断输出级别；debug 时打印每次目标目录解析的细节")
+    parser.add_argument("--progress-interval", type=float, default=0.5, help="/events 推送单个条目进度的最小间隔（秒）")
     args = parser.parse_args()
+    if args.engine == "async" and aiohttp is None:
+        parser.error("--engine async 需要 aiohttp：pip install aiohttp")
 
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()), format="%(message)s")
     root_abs = os.path.abspath(args.root)
     ensure_dir(os.path.join(root_abs, "dummy.txt"))
-    run_server(args.host, args.port, root_abs, args.concurrency, args.retry)
+    run_server(
+        args.host, args.port, root_abs, args.concurrency, args.retry, per_host=args.per_host,
+        pool_size=args.pool_size, segments=args.segments, segment_threshold=args.segment_threshold * 1024 * 1024,
+        dedupe=not args.no_dedupe,
+        log_options={"flush_interval": args.log_flush_interval, "batch_size": args.log_batch,
+                     "max_bytes": args.log_max_mb * 1024 * 1024, "backups": args.log_backups,
+                     "compress": args.log_gzip},
+        progress_interval=args.progress_interval, adaptive=args.adaptive, max_concurrency=args.max_concurrency,
+        host_rps=args.host_rps, host_bps=args.host_mbps * 1024 * 1024, retry_base=args.retry_base,
+        retry_cap=args.retry_cap, copy_buffer=args.copy_buffer * 1024, preallocate=args.preallocate,
+        verify=args.verify, journal=not args.no_journal, engine=args.engine, fanout=args.fanout,
+        min_free=args.min_free_mb * 1024 * 1024, disk_bps=args.disk_mbps * 1024 * 1024,
+        disk_policy=args.disk_policy, disk_hold=args.disk_hold_minutes * 60)
 
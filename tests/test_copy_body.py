@@ -0,0 +1,72 @@
+"""_copy_body 的 readinto 快速路径：只在前提成立时使用，读完后 urllib3 记账正确、连接可复用。"""
+
+import io
+import os
+import sys
+import unittest
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+
+import local_downloader  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+SIZE = 300000
+
+
+class CopyBodyTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.cdn = MockCDN().start()
+        cls.url = f"{cls.cdn.base_url}/v/body.mp4?size={SIZE}"
+        cls.expected = requests.get(cls.url).content
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cdn.stop()
+
+    def test_fast_path_matches_and_keeps_connection(self):
+        self.cdn.reset_stats()
+        with requests.Session() as session:
+            for _ in range(2):
+                with session.get(self.url, stream=True) as r:
+                    self.assertIsNotNone(local_downloader._raw_body(r))
+                    out = io.BytesIO()
+                    self.assertEqual(local_downloader._copy_body(r, out, None, 64 * 1024), SIZE)
+                    self.assertEqual(out.getvalue(), self.expected)
+                    self.assertEqual(r.raw._fp_bytes_read, SIZE)
+                    self.assertEqual(r.raw.length_remaining, 0)
+        self.assertEqual(self.cdn.connections, 1)
+
+    def test_limit_stops_early(self):
+        with requests.get(self.url, stream=True) as r:
+            out = io.BytesIO()
+            self.assertEqual(local_downloader._copy_body(r, out, 1000, 64 * 1024), 1000)
+            self.assertEqual(out.getvalue(), self.expected[:1000])
+            self.assertEqual(r.raw.length_remaining, SIZE - 1000)
+
+    def test_encoded_response_falls_back(self):
+        with requests.get(self.url, stream=True) as r:
+            r.headers["Content-Encoding"] = "gzip"
+            self.assertIsNone(local_downloader._raw_body(r))
+
+    def test_unexpected_internals_fall_back(self):
+        with requests.get(self.url, stream=True) as r:
+            # 模拟上游改了内部结构：_fp 不再是 http.client.HTTPResponse
+            real_fp = r.raw._fp
+            r.raw._fp = io.BytesIO()
+            self.assertIsNone(local_downloader._raw_body(r))
+            r.raw._fp = real_fp
+        r = requests.Response()
+        r.raw = io.BytesIO(self.expected)
+        self.assertIsNone(local_downloader._raw_body(r))
+        out = io.BytesIO()
+        self.assertEqual(local_downloader._copy_body(r, out, None, 64 * 1024), SIZE)
+        self.assertEqual(out.getvalue(), self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
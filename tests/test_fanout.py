@@ -0,0 +1,83 @@
+"""多目标放置失败时只重试放置，不重新下载。"""
+
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+
+import local_downloader  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+
+class FanoutRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.cdn = MockCDN().start()
+        self.root = tempfile.mkdtemp(prefix="jdvideo-test-")
+        self.server = local_downloader.create_server("127.0.0.1", 0, self.root, 2, 2, retry_base=0.01,
+                                                     journal=False)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cdn.stop()
+
+    def _wait(self, job_id: str) -> dict:
+        deadline = time.monotonic() + 20
+        while time.monotonic() < deadline:
+            job = requests.get(f"{self.base}/jobs/{job_id}").json()["job"]
+            if job["state"] == "done":
+                return job
+            time.sleep(0.05)
+        self.fail("job did not finish")
+
+    def test_failed_placement_does_not_refetch(self):
+        # 目标目录的路径上是一个普通文件：每次放置都会失败
+        blocker = os.path.join(self.root, "blocked")
+        with open(blocker, "w") as f:
+            f.write("x")
+        items = [{"sku": "1", "title": "t", "videoUrl": f"{self.cdn.base_url}/v/fanout.mp4?size=5000000"}]
+        self.cdn.reset_stats()
+        job_id = requests.post(f"{self.base}/download", json={
+            "items": items, "target_dir": self.root, "sub_dir": "main",
+            "destinations": [{"target_dir": blocker, "sub_dir": "x"}]}).json()["job_id"]
+        job = self._wait(job_id)
+        self.assertEqual(job["counts"]["fail"], 1)
+        self.assertEqual(self.cdn.requests, 1)
+        self.assertEqual(os.path.getsize(job["items"][0]["path"]), 5000000)
+
+    def test_placement_recovers_without_refetch(self):
+        target = os.path.join(self.root, "later")
+        real_place_copy = local_downloader.place_copy
+        calls = []
+
+        def flaky_place_copy(src, dst, *args, **kwargs):
+            # 第一次放置失败，之后恢复正常
+            calls.append(dst)
+            if len(calls) == 1:
+                raise PermissionError(13, "Permission denied", dst)
+            return real_place_copy(src, dst, *args, **kwargs)
+
+        items = [{"sku": "2", "title": "t", "videoUrl": f"{self.cdn.base_url}/v/fanout2.mp4?size=200000"}]
+        self.cdn.reset_stats()
+        with mock.patch.object(local_downloader, "place_copy", flaky_place_copy):
+            job_id = requests.post(f"{self.base}/download", json={
+                "items": items, "target_dir": self.root, "sub_dir": "main", "destinations": [target]}).json()["job_id"]
+            job = self._wait(job_id)
+        self.assertEqual(job["counts"]["ok"], 1)
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.cdn.requests, 1)
+        self.assertTrue(os.path.exists(job["items"][0]["copies"][0]["path"]))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""/logs 索引跨轮转：上一段未压缩时仍可查询，时间戳只取服务端时间。"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import local_downloader  # noqa: E402
+
+
+def drain(index, **filters) -> list:
+    rows, cursor = [], 0
+    while cursor is not None:
+        items, cursor = index.query(cursor=cursor, limit=7, **filters)
+        rows += items
+    return rows
+
+
+class LogIndexTest(unittest.TestCase):
+    def _writer(self, compress: bool):
+        log_file = os.path.join(tempfile.mkdtemp(prefix="jdvideo-test-"), "logs", "jdvideo.log")
+        writer = local_downloader.LogWriter(log_file, index=local_downloader.LogIndex(log_file), max_bytes=3000,
+                                            backups=3, compress=compress, flush_interval=0.01)
+        self.addCleanup(writer.close)
+        return log_file, writer
+
+    def _fill(self, writer, count: int):
+        for i in range(count):
+            writer.write({"event": f"e{i % 2}", "sku": str(i), "pad": "x" * 50})
+            writer.flush(timeout=2)
+
+    def test_previous_segment_stays_queryable(self):
+        log_file, writer = self._writer(compress=False)
+        self._fill(writer, 100)
+        rows = drain(writer.index)
+        skus = [int(row["sku"]) for row in rows]
+        self.assertEqual(skus, list(range(skus[0], 100)))
+        with open(log_file + ".1") as f:
+            self.assertEqual(int(json.loads(f.readline())["sku"]), skus[0])
+        self.assertEqual(drain(writer.index, event="e0"), [row for row in rows if row["event"] == "e0"])
+        self.assertTrue(writer.history_truncated())
+        reloaded = local_downloader.LogIndex(log_file)
+        reloaded.load()
+        self.addCleanup(reloaded.close)
+        self.assertEqual(drain(reloaded), rows)
+
+    def test_compressed_history_is_reported(self):
+        log_file, writer = self._writer(compress=True)
+        self._fill(writer, 100)
+        rows = drain(writer.index)
+        self.assertEqual(rows[-1]["sku"], "99")
+        self.assertTrue(writer.history_truncated())
+        self.assertEqual(writer.index.first_ts(), rows[0]["ts"])
+
+    def test_client_ts_does_not_reorder_index(self):
+        log_file, writer = self._writer(compress=False)
+        for _ in range(3):
+            writer.write({"event": "x", "ts": int(time.time() * 1000)})
+        writer.flush(timeout=2)
+        with open(log_file, "a") as f:
+            f.write(json.dumps({"ts": "bogus", "event": "y"}) + "\n")
+        writer.close()
+        os.remove(log_file + ".idx")
+        index = local_downloader.LogIndex(log_file)
+        index.load()
+        self.addCleanup(index.close)
+        self.assertEqual(len(index.query(until=time.time() + 1)[0]), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+"""分段下载完成后不留下单连接下载的续传元数据。"""
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "bench"))
+
+import local_downloader  # noqa: E402
+from mock_cdn import MockCDN  # noqa: E402
+
+
+class SegmentedTest(unittest.TestCase):
+    def setUp(self):
+        self.cdn = MockCDN().start()
+        self.addCleanup(self.cdn.stop)
+
+    def test_stale_part_meta_is_removed(self):
+        url = f"{self.cdn.base_url}/v/seg.mp4?size=400000"
+        path = os.path.join(tempfile.mkdtemp(prefix="jdvideo-test-"), "v", "seg.mp4")
+        os.makedirs(os.path.dirname(path))
+        # 之前一次单连接下载中断后留下的残片与元数据
+        with open(path + ".part", "wb") as f:
+            f.write(b"\0" * 1000)
+        with open(path + ".part.json", "w") as f:
+            json.dump({"etag": '"stale"', "total": 400000}, f)
+        probe = local_downloader.probe_range(url)
+        ok, err = local_downloader.download_segmented(url, path, probe, 4)
+        self.assertTrue(ok, err)
+        self.assertFalse(os.path.exists(path + ".part"))
+        self.assertFalse(os.path.exists(path + ".part.json"))
+        self.assertEqual(open(path, "rb").read(), requests.get(url).content)
+
+
+if __name__ == "__main__":
+    unittest.main()